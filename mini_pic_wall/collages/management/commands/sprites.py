@@ -0,0 +1,25 @@
+import time
+from itertools import islice
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from collages.models import Collage
+
+
+class Command(BaseCommand):
+    help = 'Make sprites of collages whose sprites are missing or outdated'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_BATCH_SIZE)
+
+    def handle(self, *args, batch_size, **options):
+        collage_pks = Collage.objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=batch_size)
+
+        start = time.monotonic()
+        seen_count = made_count = 0
+        while batch := list(islice(collage_pks, batch_size)):
+            made_count += len(Collage.make_sprites_now(batch))
+            seen_count += len(batch)
+            self.stdout.write(f'{made_count} sprites made, last collage {batch[-1]}')
+
+        self.stdout.write(self.style.SUCCESS(f'Made {made_count} sprites of {seen_count} collages '
+                                             f'in {time.monotonic() - start:.1f}s'))
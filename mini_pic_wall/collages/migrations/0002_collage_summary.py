@@ -0,0 +1,36 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def update_summaries(apps, schema_editor):
+    Collage = apps.get_model('collages', 'Collage')
+    attached = Collage.pictures.through.objects.filter(collage_id=models.OuterRef('pk')).order_by()
+    picture_count = attached.values('collage_id').annotate(count=models.Count('pk')).values('count')
+    cover = attached.order_by('picture_id').values('picture_id')[:1]
+    Collage.objects.update(picture_count=Coalesce(models.Subquery(picture_count), 0),
+                           cover=models.Subquery(cover))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collages', '0001_initial'),
+        ('pictures', '0004_image_ref_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collage',
+            name='cover',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pictures.picture'),
+        ),
+        migrations.AddField(
+            model_name='collage',
+            name='picture_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(update_summaries, migrations.RunPython.noop),
+    ]
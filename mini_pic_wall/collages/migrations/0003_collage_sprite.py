@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collages', '0002_collage_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collage',
+            name='sprite',
+            field=models.ImageField(blank=True, editable=False, upload_to='sprites/'),
+        ),
+        migrations.AddField(
+            model_name='collage',
+            name='sprite_map',
+            field=models.JSONField(default=list, editable=False),
+        ),
+    ]
@@ -1,16 +1,99 @@
-from django.db import models
+import contextlib
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.conf import settings
-from pictures.models import Picture
+from django.core.files.base import ContentFile
+from mini_pic_wall.batching import add_on_commit, apply_async_in_batches
+from mini_pic_wall.cache import bump_versions_on_commit
+from pictures import engine
+from pictures.models import Image, Picture
+from .tasks import make_collage_sprites
+
+
+class CollageQuerySet(models.QuerySet):
+    # thumbnails of the covers are prefetched by CollageListSerializer,
+    # together with those of the previews
+    def with_covers(self):
+        return self.select_related('cover__image')
 
 
 class Collage(models.Model):
     name = models.CharField(max_length=255)
     pictures = models.ManyToManyField(Picture)
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    picture_count = models.PositiveIntegerField(default=0, editable=False)
+    cover = models.ForeignKey(Picture, null=True, editable=False, on_delete=models.SET_NULL, related_name='+')
+    # thumbnails of the pictures packed into one image, and where each of them is:
+    # [{'picture': pk, 'thumbnail': name, 'x': x, 'y': y, 'width': width, 'height': height}]
+    sprite = models.ImageField(upload_to='sprites/', blank=True, editable=False)
+    sprite_map = models.JSONField(default=list, editable=False)
+    preview_size = 4
+    sprite_size = 256
+    sprite_columns = 16
+
+    objects = CollageQuerySet.as_manager()
 
     class Meta:
         default_related_name = '%(model_name)ss'
         ordering = ['pk']
 
+    # recounts pictures and picks the first one as the cover in a single update
+    @classmethod
+    def update_summaries(cls, collage_pks):
+        attached = cls.pictures.through.objects.filter(collage_id=models.OuterRef('pk')).order_by()
+        picture_count = attached.values('collage_id').annotate(count=models.Count('pk')).values('count')
+        cover = attached.order_by('picture_id').values('picture_id')[:1]
+        cls.objects.filter(pk__in=collage_pks).update(picture_count=Coalesce(models.Subquery(picture_count), 0),
+                                                      cover=models.Subquery(cover))
+
+    @staticmethod
+    def make_sprites_async(collage_pks):
+        apply_async_in_batches(make_collage_sprites, sorted(set(collage_pks)), settings.THUMBNAIL_BATCH_SIZE)
+
+    @classmethod
+    def make_sprites_now(cls, collage_pks):
+        return [collage for collage in cls.objects.filter(pk__in=collage_pks) if collage.make_sprite_now()]
+
+    # tiles of pictures that are still attached are copied from the old sprite,
+    # so only thumbnails of newly attached pictures are read
+    def make_sprite_now(self):
+        with transaction.atomic():
+            # builds of a collage wait for each other, so each one starts from the
+            # pictures and the sprite the previous one committed
+            locked = Collage.objects.select_for_update().filter(pk=self.pk).values('sprite', 'sprite_map').first()
+            if locked is None: return False
+            self.sprite, self.sprite_map = locked['sprite'], locked['sprite_map']
+
+            pictures = list(self.pictures.exclude(image__thumbnail='').order_by('pk')
+                            .values_list('pk', 'image__thumbnail')[:self.sprite_size])
+            if [(tile['picture'], tile['thumbnail']) for tile in self.sprite_map] == pictures:
+                return False
+
+            old_sprite = self.sprite.name
+            old_boxes = {(tile['picture'], tile['thumbnail']): (tile['x'], tile['y'], tile['width'], tile['height'])
+                         for tile in self.sprite_map}
+            sprite_map = []
+            if pictures:
+                storage = self.sprite.storage
+                with contextlib.ExitStack() as stack:
+                    tiles = [old_boxes.get(picture) or stack.enter_context(storage.open(picture[1]))
+                             for picture in pictures]
+                    reused = any(isinstance(tile, tuple) for tile in tiles)
+                    old_file = stack.enter_context(storage.open(old_sprite)) if reused else None
+                    file_name, content, boxes = engine.render_sprite(
+                        tiles, self.sprite_columns, Image.thumbnail_size, Image.thumbnail_format, old_file)
+                self.sprite.save(name=file_name, content=ContentFile(content), save=False)
+                sprite_map = [{'picture': picture_pk, 'thumbnail': thumbnail,
+                               'x': x, 'y': y, 'width': width, 'height': height}
+                              for (picture_pk, thumbnail), (x, y, width, height) in zip(pictures, boxes)]
+            else:
+                self.sprite = ''
+
+            Collage.objects.filter(pk=self.pk).update(sprite=self.sprite.name, sprite_map=sprite_map)
+            if old_sprite: add_on_commit(Image.delete_files_async, old_sprite)
+            bump_versions_on_commit([f'collage:{self.pk}'])
+        self.sprite_map = sprite_map
+        return True
+
     def __str__(self):
         return self.name
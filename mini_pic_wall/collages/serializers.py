@@ -1,31 +1,71 @@
+from django.db.models import Prefetch, prefetch_related_objects
 from django.urls import reverse as django_reverse
 from rest_framework import serializers
 from rest_framework.reverse import reverse as drf_reverse
 from users.serializers import HyperlinkedUserSerializer
-from pictures.serializers import HyperlinkedPictureSerializer
+from pictures.models import Picture, Rendition
+from pictures.serializers import HyperlinkedPictureSerializer, ThumbnailField
 from . import models
 
 
+def expands(request, name):
+    return request is not None and name in request.query_params.get('expand', '').split(',')
+
+
+class CollageListSerializer(serializers.ListSerializer):
+    # a page takes one query for collages with covers, one for previews and
+    # one for the thumbnail renditions of both
+    def to_representation(self, collages):
+        collages = list(collages)
+        images = [collage.cover.image for collage in collages if collage.cover]
+        if expands(self.context.get('request'), 'preview'):
+            pictures = Picture.objects.select_related('image')[:models.Collage.preview_size]
+            prefetch_related_objects(collages, Prefetch('pictures', queryset=pictures, to_attr='preview_pictures'))
+            images += [picture.image for collage in collages for picture in collage.preview_pictures]
+
+        thumbnails = Rendition.objects.filter(name='thumbnail')
+        prefetch_related_objects(images, Prefetch('renditions', queryset=thumbnails))
+        return super().to_representation(collages)
+
 class HyperlinkedCollageSerializer(serializers.HyperlinkedModelSerializer):
+    cover = ThumbnailField(source='cover.image', allow_null=True)
+    preview = HyperlinkedPictureSerializer(source='preview_pictures', many=True, read_only=True)
+
     class Meta:
         model = models.Collage
-        fields = ['url', 'name']
+        fields = ['url', 'name', 'picture_count', 'cover', 'preview']
+        list_serializer_class = CollageListSerializer
 
     def __init__(self, *args, **kwargs):
         try: kwargs['data'] = kwargs['data'].values('pk', 'name')
         except: pass
         return super().__init__(*args, **kwargs)
 
+    def get_fields(self):
+        fields = super().get_fields()
+        if not expands(self.context.get('request'), 'preview'):
+            del fields['preview']
+        return fields
+
 
 class CollageSerializer(serializers.ModelSerializer):
     pictures = serializers.HyperlinkedIdentityField(view_name='collage-pictures')
     attach = serializers.HyperlinkedIdentityField(view_name='collage-attach')
     detach = serializers.HyperlinkedIdentityField(view_name='collage-detach')
     owner = HyperlinkedUserSerializer(read_only=True)
+    sprite_map = serializers.SerializerMethodField()
 
     class Meta:
         model = models.Collage
-        fields = ['name', 'pictures', 'attach', 'detach', 'owner']
+        fields = ['name', 'pictures', 'attach', 'detach', 'owner', 'sprite', 'sprite_map']
+
+    def get_sprite_map(self, collage):
+        return [{key: tile[key] for key in ['picture', 'x', 'y', 'width', 'height']}
+                for tile in collage.sprite_map]
+
+
+class PicturePksSerializer(serializers.Serializer):
+    pictures = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
 
 
 class PictureOptionSerializer(HyperlinkedPictureSerializer):
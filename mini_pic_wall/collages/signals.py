@@ -0,0 +1,79 @@
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from mini_pic_wall.batching import add_on_commit
+from mini_pic_wall.cache import bump_versions_on_commit
+from pictures.models import Image, Picture, thumbnails_created
+from . import models
+
+
+def get_collage_scopes(collage):
+    return ['collages', f'collage:{collage.pk}', f'user:{collage.owner.username}']
+
+# collage lists show picture counts and covers
+def get_summary_scopes(collage_pks):
+    owners = models.Collage.objects.filter(pk__in=collage_pks).values_list('owner__username', flat=True)
+    return ['collages', *{f'user:{username}' for username in owners}]
+
+@receiver(post_save, sender=models.Collage, dispatch_uid="invalidate_saved_collage")
+def invalidate_saved_collage(sender, instance, **kwargs):
+    bump_versions_on_commit(get_collage_scopes(instance))
+
+@receiver(pre_delete, sender=models.Collage, dispatch_uid="collect_collage_pictures")
+def collect_collage_pictures(sender, instance, **kwargs):
+    instance._picture_pks = list(instance.pictures.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=models.Collage, dispatch_uid="invalidate_deleted_collage")
+def invalidate_deleted_collage(sender, instance, **kwargs):
+    picture_scopes = [f'picture:{picture_pk}' for picture_pk in instance._picture_pks]
+    bump_versions_on_commit(get_collage_scopes(instance) + picture_scopes)
+
+@receiver(m2m_changed, sender=models.Collage.pictures.through, dispatch_uid="invalidate_attached_pictures")
+def invalidate_attached_pictures(sender, instance, action, reverse, pk_set, **kwargs):
+    related = instance.collages if reverse else instance.pictures
+    if action == 'pre_clear':
+        instance._cleared_pks = set(related.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = instance._cleared_pks
+    elif action not in ['post_add', 'post_remove']:
+        return
+
+    collage_pks, picture_pks = (pk_set, [instance.pk]) if reverse else ([instance.pk], pk_set)
+    models.Collage.update_summaries(collage_pks)
+    make_sprites_on_commit(collage_pks)
+    bump_versions_on_commit(get_summary_scopes(collage_pks) +
+                            [f'collage:{collage_pk}' for collage_pk in collage_pks] +
+                            [f'picture:{picture_pk}' for picture_pk in picture_pks])
+
+@receiver(post_delete, sender=Picture, dispatch_uid="update_picture_collages")
+def update_picture_collages(sender, instance, **kwargs):
+    if not instance._collage_pks: return
+
+    models.Collage.update_summaries(instance._collage_pks)
+    bump_versions_on_commit(get_summary_scopes(instance._collage_pks))
+    make_sprites_on_commit(instance._collage_pks)
+
+
+def make_sprites_on_commit(collage_pks):
+    for collage_pk in collage_pks:
+        add_on_commit(models.Collage.make_sprites_async, collage_pk)
+
+@receiver(thumbnails_created, dispatch_uid="make_sprites_with_thumbnails")
+def make_sprites_with_thumbnails(sender, images, **kwargs):
+    if not images: return
+
+    attached_pictures = models.Collage.pictures.through.objects.filter(picture__image__in=images)
+    make_sprites_on_commit(set(attached_pictures.values_list('collage_id', flat=True)))
+
+# collage lists show covers, which usually get their thumbnails after being attached
+@receiver(thumbnails_created, dispatch_uid="invalidate_collage_covers")
+def invalidate_collage_covers(sender, images, **kwargs):
+    if not images: return
+
+    collage_pks = list(models.Collage.objects.filter(cover__image__in=images).values_list('pk', flat=True))
+    if collage_pks:
+        bump_versions_on_commit(get_summary_scopes(collage_pks))
+
+@receiver(post_delete, sender=models.Collage, dispatch_uid="delete_collage_sprite")
+def delete_collage_sprite(sender, instance, **kwargs):
+    if instance.sprite: add_on_commit(Image.delete_files_async, instance.sprite.name)
@@ -0,0 +1,7 @@
+from celery import shared_task
+from . import models
+
+
+@shared_task(ignore_result=True)
+def make_collage_sprites(collage_pks):
+    models.Collage.make_sprites_now(collage_pks)
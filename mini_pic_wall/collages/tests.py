@@ -1,14 +1,21 @@
 from django.urls import resolve
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from rest_framework import test
 from rest_framework.reverse import reverse
-from pictures.tests import make_picture
+from mini_pic_wall.cache import bump_versions
+from pictures.models import Image
+from pictures.tests import make_picture, override_media_root
 from .models import Collage
+from PIL import Image as PilImage
+from unittest import mock
 
 
+@override_media_root
 class CollageViewAPITestCase(test.APITestCase):
     def setUp(self):
         self.factory = test.APIRequestFactory()
+        cache.clear()
 
     def test_list_collages(self):
         user = User.objects.create(username='user_name')
@@ -20,7 +27,7 @@ class CollageViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('collage-detail', request=request, args=[collage1.pk]))
         self.assertEqual(response.data['results'][0]['name'], collage1.name)
@@ -28,6 +35,92 @@ class CollageViewAPITestCase(test.APITestCase):
                          reverse('collage-detail', request=request, args=[collage2.pk]))
         self.assertEqual(response.data['results'][1]['name'], collage2.name)
 
+    def test_list_collages_with_summaries(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='collage', owner=user)
+        empty_collage = Collage.objects.create(name='empty collage', owner=user)
+        picture1, picture2 = make_picture(owner=user), make_picture(owner=user)
+        picture1.image.make_thumbnail_now()
+        collage.pictures.add(picture2, picture1)
+
+        url = reverse('collage-list')
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['picture_count'], 2)
+        self.assertTrue(response.data['results'][0]['cover'].endswith(picture1.image.thumbnail.url))
+        self.assertEqual(response.data['results'][1]['picture_count'], 0)
+        self.assertIsNone(response.data['results'][1]['cover'])
+
+        picture1.delete()
+        collage.refresh_from_db()
+        self.assertEqual((collage.picture_count, collage.cover), (1, picture2))
+
+        picture2.collages.clear()
+        collage.refresh_from_db()
+        self.assertEqual((collage.picture_count, collage.cover), (0, None))
+
+    def test_list_collages_after_cover_thumbnail_made(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='collage', owner=user)
+        picture = make_picture(owner=user)
+        collage.pictures.add(picture)
+
+        url = reverse('collage-list')
+        self.assertIsNone(self.client.get(url).data['results'][0]['cover'])
+        with mock.patch('collages.models.make_collage_sprites'), self.captureOnCommitCallbacks(execute=True):
+            picture.image.make_thumbnail_now()
+
+        response = self.client.get(url)
+        self.assertTrue(response.data['results'][0]['cover'].endswith(picture.image.thumbnail.url))
+
+    def test_list_collages_with_previews(self):
+        user = User.objects.create(username='user_name')
+        collages = [Collage.objects.create(name=f'collage{i}', owner=user) for i in range(3)]
+        pictures = [make_picture(owner=user) for i in range(6)]
+        collages[0].pictures.add(*pictures)
+        collages[1].pictures.add(pictures[5])
+
+        for url in [reverse('collage-list'), reverse('user-collages', args=[user.username])]:
+            with self.assertNumQueries(3):
+                response = self.client.get(url + '?expand=preview')
+
+            self.assertEqual(response.status_code, 200)
+            previews = [[picture['name'] for picture in collage['preview']] for collage in response.data['results']]
+            self.assertEqual([len(preview) for preview in previews], [4, 1, 0])
+            self.assertEqual(response.data['results'][1]['preview'][0]['url'],
+                             'http://testserver' + reverse('picture-detail', args=[pictures[5].pk]))
+
+        response = self.client.get(reverse('collage-list'))
+        self.assertNotIn('preview', response.data['results'][0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pictures[5].name = 'renamed'
+            pictures[5].save()
+        response = self.client.get(reverse('collage-list') + '?expand=preview')
+        self.assertEqual(response.data['results'][1]['preview'][0]['name'], 'renamed')
+
+    def test_list_collages_using_cursor(self):
+        user = User.objects.create(username='user_name')
+        collages = [Collage.objects.create(name=f'collage{i}', owner=user) for i in range(12)]
+
+        url = reverse('collage-list')
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.data)
+        self.assertIsNone(response.data['previous'])
+        self.assertEqual(len(response.data['results']), 10)
+
+        response = self.client.get(response.data['next'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['next'])
+        self.assertIsNotNone(response.data['previous'])
+        self.assertEqual([result['name'] for result in response.data['results']],
+                         [collage.name for collage in collages[10:]])
+
     def test_retrieve_collage(self):
         user = User.objects.create(username='user_name')
         collage = Collage.objects.create(name='name of collage', owner=user)
@@ -48,6 +141,83 @@ class CollageViewAPITestCase(test.APITestCase):
                          reverse('user-detail', request=request, args=[user.username]))
         self.assertEqual(response.data['owner']['username'], user.username)
 
+    def test_retrieve_collage_with_sprite(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        pictures = [make_picture(owner=user) for _i in range(2)]
+        for picture in pictures:
+            picture.image.make_thumbnail_now()
+
+        url = reverse('collage-attach', args=[collage.pk])
+        self.client.force_authenticate(user=user)
+        with mock.patch('collages.models.make_collage_sprites') as make_collage_sprites:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(url, {'pictures': [picture.pk for picture in pictures]}, format='json')
+        make_collage_sprites.apply_async.assert_called_once_with(args=([collage.pk],), ignore_result=True)
+        Collage.make_sprites_now([collage.pk])
+
+        response = self.client.get(reverse('collage-detail', args=[collage.pk]))
+
+        collage.refresh_from_db()
+        self.assertTrue(response.data['sprite'].endswith(collage.sprite.url))
+        self.assertEqual(response.data['sprite_map'], [
+            {'picture': pictures[0].pk, 'x': 0, 'y': 0, 'width': 16, 'height': 16},
+            {'picture': pictures[1].pk, 'x': Image.thumbnail_size[0], 'y': 0, 'width': 16, 'height': 16}])
+        with PilImage.open(collage.sprite) as sprite:
+            self.assertEqual(sprite.size, (2 * Image.thumbnail_size[0], Image.thumbnail_size[1]))
+
+    def test_make_sprite_reusing_old_tiles(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        pictures = [make_picture(owner=user) for _i in range(3)]
+        for picture in pictures:
+            picture.image.make_thumbnail_now()
+        collage.pictures.add(pictures[0], pictures[1])
+        self.assertTrue(collage.make_sprite_now())
+        old_sprite = collage.sprite.name
+
+        collage.pictures.remove(pictures[0])
+        collage.pictures.add(pictures[2])
+        storage = collage.sprite.storage
+        with mock.patch.object(storage, 'open', wraps=storage.open) as storage_open:
+            with mock.patch('pictures.models.delete_files') as delete_files:
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertTrue(collage.make_sprite_now())
+
+        self.assertEqual([call.args[0] for call in storage_open.call_args_list],
+                         [pictures[2].image.thumbnail.name, old_sprite])
+        delete_files.apply_async.assert_called_once_with(args=([old_sprite],), ignore_result=True)
+        self.assertEqual([(tile['picture'], tile['x']) for tile in collage.sprite_map],
+                         [(pictures[1].pk, 0), (pictures[2].pk, Image.thumbnail_size[0])])
+        self.assertFalse(collage.make_sprite_now())
+
+        collage.pictures.clear()
+        self.assertTrue(collage.make_sprite_now())
+        self.assertEqual((collage.sprite.name, collage.sprite_map), ('', []))
+
+    def test_make_sprite_after_another_build(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        pictures = [make_picture(owner=user) for _i in range(3)]
+        for picture in pictures:
+            picture.image.make_thumbnail_now()
+        collage.pictures.add(pictures[0])
+        collage.make_sprite_now()
+        stale_collage = Collage.objects.get(pk=collage.pk)
+
+        # another build replaces the sprite, and the old one is deleted on commit
+        collage.pictures.add(pictures[1])
+        old_sprite = collage.sprite.name
+        collage.make_sprite_now()
+        collage.sprite.storage.delete(old_sprite)
+
+        collage.pictures.add(pictures[2])
+        self.assertTrue(stale_collage.make_sprite_now())
+
+        collage.refresh_from_db()
+        self.assertEqual(collage.sprite, stale_collage.sprite)
+        self.assertEqual([tile['picture'] for tile in collage.sprite_map], [picture.pk for picture in pictures])
+
     def test_delete_collage(self):
         user = User.objects.create(username='user_name')
         collage = Collage.objects.create(name='name of collage', owner=user)
@@ -73,7 +243,7 @@ class CollageViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request, pk=collage.pk)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('picture-detail', request=request, args=[picture1.pk]))
         self.assertEqual(response.data['results'][0]['name'], picture1.name)
@@ -83,6 +253,64 @@ class CollageViewAPITestCase(test.APITestCase):
         self.assertEqual(response.data['results'][1]['name'], picture2.name)
         self.assertIn('thumbnail', response.data['results'][1])
 
+    def test_list_collage_pictures_from_cache(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        picture1 = make_picture(owner=user)
+        picture2 = make_picture(owner=user)
+        collage.pictures.add(picture1)
+
+        url = reverse('collage-pictures', args=[collage.pk])
+        response = self.client.get(url)
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(url)
+
+        self.assertEqual(cached_response.status_code, 200)
+        self.assertEqual(cached_response.data, response.data)
+
+        self.client.force_authenticate(user=user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('collage-attach-picture', args=[collage.pk, picture2.pk]))
+        self.client.force_authenticate(user=None)
+        response = self.client.get(url)
+
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_list_collage_pictures_not_modified(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        picture = make_picture(owner=user)
+
+        url = reverse('collage-pictures', args=[collage.pk])
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        self.client.force_authenticate(user=user)
+        with mock.patch('collages.models.make_collage_sprites'), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('collage-attach-picture', args=[collage.pk, picture.pk]))
+        self.client.force_authenticate(user=None)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_list_collage_pictures_modified_within_a_second(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+
+        url = reverse('collage-pictures', args=[collage.pk])
+        last_modified = self.client.get(url).headers['Last-Modified']
+        bump_versions([f'collage:{collage.pk}'])
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(response.status_code, 200)
+
     def test_list_pictures_to_attach(self):
         user = User.objects.create(username='user_name')
         collage = Collage.objects.create(name='name of collage', owner=user)
@@ -96,7 +324,7 @@ class CollageViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request, pk=collage.pk)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('picture-detail', request=request, args=[picture1.pk]))
         self.assertEqual(response.data['results'][0]['attach'],
@@ -182,7 +410,7 @@ class CollageViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request, pk=collage.pk)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('picture-detail', request=request, args=[picture1.pk]))
         self.assertEqual(response.data['results'][0]['detach'],
@@ -230,3 +458,58 @@ class CollageViewAPITestCase(test.APITestCase):
 
         self.assertEqual(response.status_code, 403)
         self.assertEqual(collage.pictures.count(), 1)
+
+    def test_attach_pictures(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        pictures = [make_picture(owner=user) for _i in range(3)]
+        collage.pictures.add(pictures[0])
+        another_picture = make_picture(owner=User.objects.create(username='another_user'))
+        picture_pks = [picture.pk for picture in pictures] + [another_picture.pk, 0]
+
+        url = reverse('collage-attach', args=[collage.pk])
+        self.client.force_authenticate(user=user)
+        with self.assertNumQueries(7):
+            response = self.client.post(url, {'pictures': picture_pks}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['result'] for result in response.data['results']], [
+            'Already attached', 'Successfully attached', 'Successfully attached',
+            'You do not own this picture', 'No such picture'])
+        self.assertEqual(list(collage.pictures.all()), pictures)
+
+    def test_attach_pictures_while_not_owning_collage(self):
+        user = User.objects.create(username='user')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        picture = make_picture()
+
+        url = reverse('collage-attach', args=[collage.pk])
+        self.client.force_authenticate(user=picture.owner)
+        response = self.client.post(url, {'pictures': [picture.pk]}, format='json')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(collage.pictures.count(), 0)
+
+    def test_attach_pictures_to_missing_collage(self):
+        picture = make_picture()
+
+        url = reverse('collage-attach', args=[0])
+        self.client.force_authenticate(user=picture.owner)
+        response = self.client.post(url, {'pictures': [picture.pk]}, format='json')
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_detach_pictures(self):
+        user = User.objects.create(username='user_name')
+        collage = Collage.objects.create(name='name of collage', owner=user)
+        pictures = [make_picture(owner=user) for _i in range(3)]
+        collage.pictures.add(pictures[0], pictures[1])
+
+        url = reverse('collage-detach', args=[collage.pk])
+        self.client.force_authenticate(user=user)
+        response = self.client.post(url, {'pictures': [picture.pk for picture in pictures]}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['result'] for result in response.data['results']], [
+            'Successfully detached', 'Successfully detached', 'Already detached'])
+        self.assertEqual(collage.pictures.count(), 0)
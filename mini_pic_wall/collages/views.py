@@ -1,4 +1,6 @@
-from django.db.models import Subquery
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Subquery
+from django.db.models.signals import m2m_changed
 from django.db.models.query import EmptyQuerySet
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.serializers import Serializer as EmptySerializer
@@ -6,6 +8,8 @@ from rest_framework.response import Response
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.exceptions import PermissionDenied
+from rest_framework.generics import get_object_or_404
+from mini_pic_wall.cache import CachedResponseMixin
 from users import permissions
 from pictures.models import Picture
 from pictures.serializers import HyperlinkedPictureSerializer
@@ -13,7 +17,7 @@ from . import serializers
 from .models import Collage
 
 
-class CollageViewSet(ModelViewSet):
+class CollageViewSet(CachedResponseMixin, ModelViewSet):
     def get_object(self):
         if self.action == 'retrieve':
             assert 'owner' in self.get_serializer_class().Meta.fields
@@ -28,13 +32,13 @@ class CollageViewSet(ModelViewSet):
     def get_queryset(self):
         match self.action:
             case 'list':
-                return Collage.objects.all()
+                return Collage.objects.with_covers()
             case 'pictures' | 'detach':
-                return Picture.objects.filter(collages=self.kwargs['pk'])
+                return Picture.objects.with_thumbnails().filter(collages=self.kwargs['pk'])
             case 'attach':
                 collage = Collage.objects.filter(pk=self.kwargs['pk'])
                 owner_of_collage = Subquery(collage.values('owner_id'))
-                pictures_of_owner = Picture.objects.filter(owner=owner_of_collage)
+                pictures_of_owner = Picture.objects.with_thumbnails().filter(owner=owner_of_collage)
 
                 attached_pictures = (Collage.pictures.through.objects
                     .filter(collage_id=self.kwargs['pk']).values('picture_id'))
@@ -62,27 +66,89 @@ class CollageViewSet(ModelViewSet):
                 return EmptySerializer
 
     def get_serializer(self, *args, **kwargs):
-        if self.action in ['attach', 'detach']:
+        if self.action in ['attach', 'detach'] and self.request.method == 'GET':
             kwargs['collage_pk'] = self.kwargs['pk']
         return super().get_serializer(*args, **kwargs)
 
+    def get_cache_scopes(self):
+        match self.action:
+            case 'list':
+                # previews show picture names and thumbnails
+                return ['collages', 'pictures'] if serializers.expands(self.request, 'preview') else ['collages']
+            case 'retrieve' | 'pictures':
+                return [f'collage:{self.kwargs["pk"]}']
+            case _:
+                return None
+
     def get_permissions(self):
         permission_classes = [permissions.ReadOnly]
         if self.action == 'destroy':
             permission_classes = [permissions.IsObjectOwner]
+        elif self.action in ['attach', 'detach'] and self.request.method == 'POST':
+            permission_classes = [IsAuthenticated]
         return [permission() for permission in permission_classes]
 
     @action(detail=True, methods=['get'])
     def pictures(self, request, pk=None):
         return self.list(request)
 
-    @action(detail=True, methods=['get'])
+    @action(detail=True, methods=['get', 'post'])
     def attach(self, request, pk=None):
-        return self.list(request)
+        if request.method == 'GET':
+            return self.list(request)
+        return change_pictures(request, pk, attach=True)
 
-    @action(detail=True, methods=['get'])
+    @action(detail=True, methods=['get', 'post'])
     def detach(self, request, pk=None):
-        return self.list(request)
+        if request.method == 'GET':
+            return self.list(request)
+        return change_pictures(request, pk, attach=False)
+
+
+def change_pictures(request, collage_pk, attach):
+    serializer = serializers.PicturePksSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    picture_pks = serializer.validated_data['pictures']
+    through = Collage.pictures.through
+
+    with transaction.atomic():
+        collage = get_object_or_404(Collage.objects.select_for_update(), pk=collage_pk)
+        if collage.owner_id != request.user.pk:
+            raise PermissionDenied('You do not own this collage')
+
+        attached = through.objects.filter(collage_id=collage_pk, picture_id=OuterRef('pk'))
+        pictures = {pk: (owner_id, is_attached) for pk, owner_id, is_attached in
+                    Picture.objects.filter(pk__in=picture_pks)
+                    .values_list('pk', 'owner_id', Exists(attached))}
+
+        results = []
+        changed_pks = set()
+        for picture_pk in picture_pks:
+            if picture_pk not in pictures:
+                result = 'No such picture'
+            elif pictures[picture_pk][0] != request.user.pk:
+                result = 'You do not own this picture'
+            elif pictures[picture_pk][1] == attach or picture_pk in changed_pks:
+                result = 'Already attached' if attach else 'Already detached'
+            else:
+                result = 'Successfully attached' if attach else 'Successfully detached'
+                changed_pks.add(picture_pk)
+            results.append({'picture': picture_pk, 'result': result})
+
+        if changed_pks:
+            signal_kwargs = {'sender': through, 'instance': collage, 'reverse': False,
+                             'model': Picture, 'pk_set': changed_pks, 'using': collage._state.db}
+            if attach:
+                m2m_changed.send(action='pre_add', **signal_kwargs)
+                through.objects.bulk_create([through(collage_id=collage.pk, picture_id=picture_pk)
+                                             for picture_pk in changed_pks], ignore_conflicts=True)
+                m2m_changed.send(action='post_add', **signal_kwargs)
+            else:
+                m2m_changed.send(action='pre_remove', **signal_kwargs)
+                through.objects.filter(collage_id=collage.pk, picture_id__in=changed_pks).delete()
+                m2m_changed.send(action='post_remove', **signal_kwargs)
+
+    return Response({'results': results})
 
 
 @api_view(['POST'])
@@ -1,5 +1,7 @@
 #!/bin/sh
 
+if [ -n "$FILE_UPLOAD_TEMP_DIR" ]; then mkdir -p "$FILE_UPLOAD_TEMP_DIR"; fi
+
 python manage.py migrate --no-input
 python manage.py collectstatic --no-input
 
@@ -0,0 +1,31 @@
+from django.db import transaction
+
+
+class OnCommitBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.items = []
+
+    def __call__(self):
+        self.callback(self.items)
+
+
+def add_on_commit(callback, item, using=None):
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        callback([item])
+        return
+
+    for _savepoint_ids, func, _robust in connection.run_on_commit:
+        if isinstance(func, OnCommitBatch) and func.callback == callback:
+            func.items.append(item)
+            return
+
+    batch = OnCommitBatch(callback)
+    batch.items.append(item)
+    transaction.on_commit(batch, using=using)
+
+
+def apply_async_in_batches(task, items, batch_size, **options):
+    for start in range(0, len(items), batch_size):
+        task.apply_async(args=(items[start:start + batch_size],), ignore_result=True, **options)
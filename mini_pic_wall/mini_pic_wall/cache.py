@@ -0,0 +1,72 @@
+import time
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+
+def get_versions(scopes):
+    keys = ['version:' + scope for scope in scopes]
+    versions = cache.get_many(keys)
+
+    missing_keys = [key for key in keys if key not in versions]
+    if missing_keys:
+        for key in missing_keys:
+            cache.add(key, time.time_ns(), timeout=None)
+        versions.update(cache.get_many(missing_keys))
+
+    return [versions[key] for key in keys]
+
+def bump_versions(scopes):
+    version = time.time_ns()
+    cache.set_many({'version:' + scope: version for scope in scopes}, timeout=None)
+
+def bump_versions_on_commit(scopes):
+    scopes = set(scopes)
+    if scopes:
+        transaction.on_commit(lambda: bump_versions(scopes))
+
+
+class CachedResponseMixin:
+    def get_cache_scopes(self):
+        return None
+
+    def get_cache_key(self, request, versions):
+        key = repr((versions, request.build_absolute_uri(),
+                    request.accepted_media_type, request.META.get('HTTP_ACCEPT', '')))
+        return 'response:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get_cached_response(self, request, get_response, *args, **kwargs):
+        scopes = self.get_cache_scopes() if request.method == 'GET' else None
+        if scopes is None:
+            return get_response(request, *args, **kwargs)
+
+        versions = get_versions(['all', *scopes])
+        key = self.get_cache_key(request, versions)
+        etag = quote_etag(key.removeprefix('response:'))
+        last_modified = max(versions) // 10**9
+
+        # versions bumped within the same second share a Last-Modified date,
+        # so only the ETag tells whether the client's copy is current
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            data = cache.get(key)
+            if data is not None:
+                response = Response(data)
+            else:
+                response = get_response(request, *args, **kwargs)
+                if response.status_code != 200: return response
+                cache.set(key, response.data, settings.RESPONSE_CACHE_TIMEOUT)
+
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(request, super().retrieve, *args, **kwargs)
@@ -0,0 +1,126 @@
+import os
+import re
+import base64
+import hashlib
+import time
+import mimetypes
+from urllib.parse import urlsplit, unquote
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponse, HttpResponseForbidden, HttpResponseGone, Http404
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+
+content_addressed_name = re.compile(r'[0-9a-f]{64}(_\w+)?\.\w+')
+
+# the signature of nginx secure_link with secure_link_md5
+# "$secure_link_expires$uri <key>", so nginx checks signed urls by itself
+def sign_path(path, expires):
+    digest = hashlib.md5(f'{expires}{path} {settings.MEDIA_URL_SIGNING_KEY}'.encode()).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+# urls expire at the end of the lifetime after the current one, so the same url
+# is handed out for a whole lifetime and stays valid for at least another one
+def get_expires():
+    lifetime = settings.MEDIA_URL_LIFETIME
+    return (int(time.time()) // lifetime + 2) * lifetime
+
+def sign_url(url):
+    if not settings.MEDIA_URL_SIGNING_KEY: return url
+    separator = '&' if urlsplit(url).query else '?'
+    expires = get_expires()
+    return f'{url}{separator}md5={sign_path(unquote(urlsplit(url).path), expires)}&expires={expires}'
+
+def get_range(request, size):
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', request.headers.get('Range', ''))
+    if match is None or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end:
+        raise ValueError('unsatisfiable range')
+    return start, end
+
+def read_range(file, start, end, chunk_size=64 * 1024):
+    with file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk: break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# serves media files when nginx is not in front of django, honoring
+# conditional, ranged and HEAD requests like nginx would
+@require_safe
+def serve(request, path):
+    if settings.MEDIA_URL_SIGNING_KEY:
+        expires = request.GET.get('expires', '')
+        if not expires.isdigit() or not constant_time_compare(request.GET.get('md5', ''), sign_path(request.path, expires)):
+            return HttpResponseForbidden()
+        if int(expires) < time.time():
+            return HttpResponseGone()
+
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404('No such file')
+    if not os.path.isfile(full_path):
+        raise Http404('No such file')
+
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    etag = quote_etag(f'{last_modified:x}-{size:x}')
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    if response is None:
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        byte_range = None
+        # an If-Range that does not match means the client wants the whole new file
+        if request.headers.get('If-Range', etag) in [etag, http_date(last_modified)]:
+            try:
+                byte_range = get_range(request, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response.headers['Content-Range'] = f'bytes */{size}'
+                return response
+
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+        elif byte_range is None:
+            response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+        elif byte_range[1] == size - 1:
+            # the rest of the file can still be sent with sendfile
+            file = open(full_path, 'rb')
+            file.seek(byte_range[0])
+            response = FileResponse(file, content_type=content_type, status=206)
+        else:
+            response = FileResponse(read_range(open(full_path, 'rb'), *byte_range),
+                                    content_type=content_type, status=206)
+
+        if byte_range is None:
+            response.headers['Content-Length'] = size
+        else:
+            response.status_code = 206
+            response.headers['Content-Range'] = f'bytes {byte_range[0]}-{byte_range[1]}/{size}'
+            response.headers['Content-Length'] = byte_range[1] - byte_range[0] + 1
+        response.headers['Accept-Ranges'] = 'bytes'
+
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    if content_addressed_name.fullmatch(os.path.basename(path)):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -25,12 +26,41 @@ ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '').split(' ')
 
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'mini_pic_wall.pagination.PkCursorPagination',
     'PAGE_SIZE': 10
 }
 
 
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER", "redis://redis:6379/0")
+CELERY_BEAT_SCHEDULE = {
+    'collect-orphan-images': {
+        'task': 'pictures.tasks.collect_orphan_images',
+        'schedule': float(os.environ.get('ORPHAN_COLLECTION_INTERVAL', 60 * 60)),
+    },
+}
+
+THUMBNAIL_BATCH_SIZE = int(os.environ.get('THUMBNAIL_BATCH_SIZE', 50))
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', os.cpu_count()))
+DELETION_BATCH_SIZE = int(os.environ.get('DELETION_BATCH_SIZE', 500))
+SIMILAR_IMAGE_DISTANCE = 3
+MERGE_SIMILAR_UPLOADS = os.environ.get('MERGE_SIMILAR_UPLOADS', '').lower() in ['1', 'true']
+MERGE_SIMILAR_DISTANCE = int(os.environ.get('MERGE_SIMILAR_DISTANCE', 1))
+THUMBNAIL_REDUCING_GAP = float(os.environ.get('THUMBNAIL_REDUCING_GAP', 2.0)) or None
+
+
+# Cache versions are bumped by celery workers and every web worker, so the
+# cache has to be shared; tests keep it in memory of their own process
+TESTING = sys.argv[1:2] == ['test']
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.redis.RedisCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', CELERY_BROKER_URL.rsplit('/', 1)[0] + '/1'),
+    } if not TESTING else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get('RESPONSE_CACHE_TIMEOUT', 300))
 
 
 # Application definition
@@ -134,6 +164,42 @@ STATIC_ROOT = BASE_DIR / 'static'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+STORAGES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_STORAGE_BACKEND', 'pictures.storage.ShardedFileSystemStorage'),
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# Used by pictures.s3storage.ShardedS3Storage
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+S3_REGION = os.environ.get('S3_REGION')
+S3_BASE_URL = os.environ.get('S3_BASE_URL')
+
+# Workers keep originals from storages without local paths here
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR')
+MEDIA_CACHE_SIZE = int(os.environ.get('MEDIA_CACHE_SIZE', 1024 ** 3))
+
+# Serve media from django when nginx is not in front of it
+SERVE_MEDIA = os.environ.get('SERVE_MEDIA', str(DEBUG)).lower() in ['1', 'true']
+# Media urls are signed for nginx secure_link when a key is set
+MEDIA_URL_SIGNING_KEY = os.environ.get('MEDIA_URL_SIGNING_KEY', '')
+# Signed urls stay valid for one to two lifetimes; keep it above RESPONSE_CACHE_TIMEOUT
+MEDIA_URL_LIFETIME = int(os.environ.get('MEDIA_URL_LIFETIME', 24 * 60 * 60))
+
+# Uploads are hashed while they stream in. Keep FILE_UPLOAD_TEMP_DIR on the
+# same filesystem as MEDIA_ROOT so storing a large upload is a rename
+FILE_UPLOAD_HANDLERS = [
+    'pictures.uploadhandlers.MemoryFileUploadHandler',
+    'pictures.uploadhandlers.TemporaryFileUploadHandler',
+]
+FILE_UPLOAD_TEMP_DIR = os.environ.get('FILE_UPLOAD_TEMP_DIR')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
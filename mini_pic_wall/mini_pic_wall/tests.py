@@ -0,0 +1,127 @@
+from django.test import SimpleTestCase, RequestFactory, override_settings
+from django.http import Http404
+from django.utils.http import http_date
+from . import media
+import os
+import base64
+import hashlib
+import tempfile
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
+
+
+media_root = tempfile.TemporaryDirectory()
+content_addressed_name = 'a' * 64 + '.png'
+content = bytes(range(256)) * 4
+
+
+@override_settings(MEDIA_ROOT=media_root.name)
+class MediaViewTestCase(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        os.makedirs(os.path.join(media_root.name, 'images'), exist_ok=True)
+        for name in [content_addressed_name, 'name.png']:
+            with open(os.path.join(media_root.name, 'images', name), 'wb') as file:
+                file.write(content)
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def serve(self, path='images/' + content_addressed_name, method='get', data=None, **headers):
+        request = getattr(self.factory, method)('/media/' + path, data, headers=headers)
+        return media.serve(request, path)
+
+    def test_serve_file(self):
+        response = self.serve()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        self.assertEqual(response.headers['Content-Type'], 'image/png')
+        self.assertEqual(response.headers['Content-Length'], str(len(content)))
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(self.serve('images/name.png').headers['Cache-Control'], 'no-cache')
+
+    def test_serve_range(self):
+        response = self.serve(Range='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), content[10:20])
+        self.assertEqual(response.headers['Content-Range'], f'bytes 10-19/{len(content)}')
+        self.assertEqual(response.headers['Content-Length'], '10')
+
+        response = self.serve(Range='bytes=1000-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), content[1000:])
+
+        response = self.serve(Range='bytes=-24')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), content[-24:])
+
+    def test_serve_unsatisfiable_range(self):
+        response = self.serve(Range='bytes=5000-')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], f'bytes */{len(content)}')
+
+    def test_serve_range_if_range_does_not_match(self):
+        response = self.serve(Range='bytes=10-19', If_Range='"outdated"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_serve_head(self):
+        response = self.serve(method='head')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response.headers['Content-Length'], str(len(content)))
+
+    def test_serve_not_modified(self):
+        response = self.serve()
+
+        self.assertEqual(self.serve(If_Modified_Since=response.headers['Last-Modified']).status_code, 304)
+        self.assertEqual(self.serve(If_None_Match=response.headers['ETag']).status_code, 304)
+        self.assertEqual(self.serve(If_Modified_Since=http_date(0)).status_code, 200)
+
+    def test_serve_missing_file(self):
+        for path in ['images/missing.png', '../settings.py', 'images']:
+            with self.assertRaises(Http404):
+                self.serve(path)
+
+    @override_settings(MEDIA_URL_SIGNING_KEY='key')
+    def test_serve_signed(self):
+        url = media.sign_url('/media/images/' + content_addressed_name)
+        query = dict(parse_qsl(urlsplit(url).query))
+
+        self.assertEqual(self.serve(data=query).status_code, 200)
+        self.assertEqual(self.serve().status_code, 403)
+        self.assertEqual(self.serve(data={**query, 'md5': query['md5'][1:]}).status_code, 403)
+        self.assertEqual(self.serve(data={**query, 'expires': int(query['expires']) + 1}).status_code, 403)
+        self.assertEqual(self.serve('images/name.png', data=query).status_code, 403)
+
+    @override_settings(MEDIA_URL_SIGNING_KEY='key', MEDIA_URL_LIFETIME=100)
+    def test_serve_expired(self):
+        with mock.patch('time.time', return_value=1000):
+            url = media.sign_url('/media/images/' + content_addressed_name)
+        query = dict(parse_qsl(urlsplit(url).query))
+        signature = base64.urlsafe_b64encode(hashlib.md5(f'1200/media/images/{content_addressed_name} key'.encode()).digest())
+
+        self.assertEqual(query, {'md5': signature.decode().rstrip('='), 'expires': '1200'})
+        with mock.patch('time.time', return_value=1200):
+            self.assertEqual(self.serve(data=query).status_code, 200)
+        with mock.patch('time.time', return_value=1201):
+            self.assertEqual(self.serve(data=query).status_code, 410)
+
+    @override_settings(MEDIA_URL_SIGNING_KEY='key', MEDIA_URL_LIFETIME=100)
+    def test_sign_url_for_a_whole_lifetime(self):
+        with mock.patch('time.time', side_effect=[1000, 1099, 1100]):
+            urls = [media.sign_url('/media/images/name.png?a=1') for _ in range(3)]
+
+        self.assertEqual(urls[0], urls[1])
+        self.assertNotEqual(urls[1], urls[2])
+        self.assertIn('?a=1&md5=', urls[0])
+
+    def test_sign_url_without_key(self):
+        self.assertEqual(media.sign_url('/media/images/name.png'), '/media/images/name.png')
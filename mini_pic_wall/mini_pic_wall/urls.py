@@ -17,8 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
-from . import views
+from . import views, media
 
 
 api_urls = [
@@ -34,4 +33,7 @@ urlpatterns = [
     path('auth/', views.auth_root, name='auth-root'),
     path('admin/', admin.site.urls),
     path('', views.root, name='root'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+if settings.SERVE_MEDIA:
+    urlpatterns.append(path(settings.MEDIA_URL.lstrip('/') + '<path:path>', media.serve, name='media'))
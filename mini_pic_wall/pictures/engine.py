@@ -0,0 +1,201 @@
+import io
+import time
+import contextlib
+import hashlib
+import resource
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import PIL.Image
+from django.conf import settings
+
+
+Rendering = namedtuple('Rendering', ['name', 'format', 'width', 'height', 'file_name', 'content'])
+Result = namedtuple('Result', ['renderings', 'dhash'])
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_supported_formats(formats):
+    PIL.Image.init()
+    return [format for format in formats if format.upper() in PIL.Image.SAVE]
+
+def encode_image(image, format):
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format=format)
+    content = image_bytes.getvalue()
+    return hashlib.sha256(content).hexdigest() + '.' + format, content
+
+def render(path, sizes, formats, reducing_gap=None):
+    # sizes go from the largest to the smallest, so every size is downscaled
+    # from the previous one; only the smallest one is made for small originals
+    sizes = sorted(sizes, key=lambda item: item[1], reverse=True)
+    renderings = []
+
+    with PIL.Image.open(path) as image:
+        sizes = [(name, size) for index, (name, size) in enumerate(sizes)
+                 if index == len(sizes) - 1 or image.width > size[0] or image.height > size[1]]
+
+        # JPEGs are decoded straight at 1/2..1/8 scale, keeping at least
+        # reducing_gap times the largest size for the resampling that follows
+        if reducing_gap is not None:
+            width, height = sizes[0][1]
+            scale = min(width / image.width, height / image.height) * reducing_gap
+            image.draft(None, (max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+
+        for name, size in sizes:
+            image.thumbnail(size=size, reducing_gap=reducing_gap)
+
+            for format in formats:
+                file_name, content = encode_image(image, format)
+                renderings.append(Rendering(name, format, image.width, image.height, file_name, content))
+
+        dhash = get_dhash(image)
+
+    return Result(renderings, dhash)
+
+# 64 bits telling whether each pixel of a 9x8 grayscale copy is brighter than
+# its right neighbour, so re-encoded or resized copies get (nearly) equal hashes
+def get_dhash(image):
+    pixels = list(image.convert('L').resize((9, 8), PIL.Image.Resampling.LANCZOS).getdata())
+    dhash = 0
+    for row in range(8):
+        for column in range(8):
+            dhash = dhash << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return dhash
+
+def get_file_dhash(file):
+    with PIL.Image.open(file) as image:
+        image.draft('L', (64, 64))
+        return get_dhash(image)
+
+# flat or low texture images all hash to (nearly) 0, so their hashes tell nothing
+def is_textured(dhash, min_bits=8):
+    return min_bits <= bin(dhash).count('1') <= 64 - min_bits
+
+# the aspect ratio and the average colors of a 4x4 grid, telling apart images
+# with the same brightness gradients, like stretched or tinted copies
+def get_file_appearance(file):
+    with PIL.Image.open(file) as image:
+        aspect_ratio = image.width / image.height
+        image.draft('RGB', (64, 64))
+        colors = image.convert('RGB').resize((4, 4), PIL.Image.Resampling.BOX).getdata()
+        return aspect_ratio, [channel for color in colors for channel in color]
+
+def looks_same(appearance, other_appearance, max_ratio_difference=0.02, max_color_difference=8):
+    (aspect_ratio, colors), (other_aspect_ratio, other_colors) = appearance, other_appearance
+    color_difference = sum(abs(channel - other) for channel, other in zip(colors, other_colors)) / len(colors)
+    return (abs(aspect_ratio / other_aspect_ratio - 1) <= max_ratio_difference
+            and color_difference <= max_color_difference)
+
+# hashes within distance of len(chunks) - 1 share at least one whole chunk
+def split_dhash(dhash):
+    return [dhash >> shift & 0xffff for shift in (48, 32, 16, 0)]
+
+def join_dhash(chunks):
+    return chunks[0] << 48 | chunks[1] << 32 | chunks[2] << 16 | chunks[3]
+
+def get_distance(dhash, other_dhash):
+    return bin(dhash ^ other_dhash).count('1')
+
+# packs tiles row by row into a grid of cell_size cells, returning the encoded
+# sprite and the (x, y, width, height) box of every tile; a tile is a file, or
+# the box it had in old_sprite so that unchanged tiles are not decoded again
+def render_sprite(tiles, columns, cell_size, format, old_sprite=None):
+    columns = min(columns, len(tiles))
+    rows = -(-len(tiles) // columns)
+    sprite = PIL.Image.new('RGBA', (columns * cell_size[0], rows * cell_size[1]))
+    boxes = []
+
+    with contextlib.ExitStack() as stack:
+        if old_sprite is not None:
+            old_sprite = stack.enter_context(PIL.Image.open(old_sprite))
+
+        for index, tile in enumerate(tiles):
+            if isinstance(tile, tuple):
+                x, y, width, height = tile
+                image = old_sprite.crop((x, y, x + width, y + height))
+            else:
+                with PIL.Image.open(tile) as tile_image:
+                    image = tile_image.convert('RGBA')
+            image.thumbnail(cell_size)
+
+            x, y = index % columns * cell_size[0], index // columns * cell_size[1]
+            sprite.paste(image, (x, y))
+            boxes.append((x, y, image.width, image.height))
+
+    file_name, content = encode_image(sprite, format)
+    return file_name, content, boxes
+
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS,
+                                           mp_context=multiprocessing.get_context('spawn'))
+        return executor
+
+def reset_executor(broken_executor):
+    global executor
+    with executor_lock:
+        if executor is broken_executor:
+            executor = None
+    broken_executor.shutdown(wait=False, cancel_futures=True)
+
+def submit_many(jobs):
+    pool = get_executor()
+    try:
+        futures = [pool.submit(render, *job) for job in jobs]
+    except BrokenProcessPool as exception:
+        reset_executor(pool)
+        return [exception] * len(jobs)
+
+    results = [future.exception() or future.result() for future in futures]
+    if any(isinstance(result, BrokenProcessPool) for result in results):
+        reset_executor(pool)
+    return results
+
+# returns a result or the raised exception for each (path, sizes, formats, reducing_gap) job
+def render_many(jobs):
+    if len(jobs) < 2 or settings.THUMBNAIL_WORKERS < 1 or multiprocessing.current_process().daemon:
+        results = []
+        for job in jobs:
+            try: results.append(render(*job))
+            except Exception as exception: results.append(exception)
+        return results
+
+    # a worker killed, e.g. for running out of memory, breaks the whole pool;
+    # the jobs it took down are rendered once more in a new one
+    results = submit_many(jobs)
+    broken = [index for index, result in enumerate(results) if isinstance(result, BrokenProcessPool)]
+    if broken:
+        for index, result in zip(broken, submit_many([jobs[index] for index in broken])):
+            results[index] = result
+    return results
+
+# renders the jobs one by one, returning seconds per job and the peak RSS in KiB;
+# meant to be run in a fresh process so that the peak belongs to the jobs alone
+def benchmark(jobs):
+    seconds = []
+    for job in jobs:
+        start = time.perf_counter()
+        render(*job)
+        seconds.append(time.perf_counter() - start)
+    return seconds, get_peak_rss()
+
+def get_peak_rss():
+    # ru_maxrss survives exec on linux, so a spawned process would report
+    # the peak of its parent; the high water mark in /proc is reset on exec
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
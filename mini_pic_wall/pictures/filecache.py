@@ -0,0 +1,93 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+from collections import Counter
+from django.conf import settings
+
+
+# cached files in use by this process, which eviction leaves alone
+pinned = Counter()
+pinned_lock = threading.Lock()
+
+
+def get_cache_dir():
+    return settings.MEDIA_CACHE_DIR or os.path.join(tempfile.gettempdir(), 'mini_pic_wall_media')
+
+# returns a local path of a stored file; files of storages without paths are
+# downloaded once into an on-disk cache that drops the least recently used ones
+def get_path(storage, name):
+    with get_paths(storage, [name]) as [path]:
+        return path
+
+# yields local paths of stored files, keeping cached ones from being evicted
+# until the block ends, even when together they are larger than the cache
+@contextlib.contextmanager
+def get_paths(storage, names):
+    try:
+        local_paths = [storage.path(name) for name in names]
+    except NotImplementedError:
+        local_paths = None
+    if local_paths is not None:
+        yield local_paths
+        return
+
+    paths = []
+    try:
+        for name in names:
+            path = get_cache_path(name)
+            with pinned_lock:
+                pinned[path] += 1
+            paths.append(path)
+            download(storage, name, path)
+        yield paths
+    finally:
+        with pinned_lock:
+            for path in paths:
+                pinned[path] -= 1
+                if not pinned[path]: del pinned[path]
+            keep = set(pinned)
+        if paths:
+            evict(get_cache_dir(), settings.MEDIA_CACHE_SIZE, keep=keep)
+
+def get_cache_path(name):
+    _name, ext = os.path.splitext(name)
+    return os.path.join(get_cache_dir(), hashlib.sha256(name.encode()).hexdigest() + ext)
+
+def download(storage, name, path):
+    if os.path.exists(path):
+        os.utime(path)
+        return
+
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, prefix='.', delete=False) as file:
+        try:
+            with storage.open(name) as source:
+                shutil.copyfileobj(source, file)
+        except BaseException:
+            file.close()
+            os.remove(file.name)
+            raise
+    os.replace(file.name, path)
+
+    with pinned_lock:
+        keep = set(pinned)
+    evict(cache_dir, settings.MEDIA_CACHE_SIZE, keep=keep)
+
+def evict(cache_dir, max_size, keep=()):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith('.') or not entry.is_file(): continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _mtime, size, _path in entries)
+    for _mtime, size, path in sorted(entries):
+        if total_size <= max_size: break
+        if path in keep: continue
+        try: os.remove(path)
+        except FileNotFoundError: pass
+        total_size -= size
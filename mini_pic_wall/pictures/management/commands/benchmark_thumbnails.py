@@ -0,0 +1,51 @@
+import os
+import tempfile
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import PIL.Image
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pictures import engine
+from pictures.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Compare thumbnail rendering time and peak memory with and without draft-mode decoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='images to render, synthetic JPEGs are made if none are given')
+        parser.add_argument('--count', type=int, default=5)
+        parser.add_argument('--size', default='6000x4000')
+        parser.add_argument('--formats', nargs='+')
+        parser.add_argument('--reducing-gap', type=float, default=settings.THUMBNAIL_REDUCING_GAP or 2.0)
+
+    def handle(self, *args, paths, count, size, formats, reducing_gap, **options):
+        sizes, default_formats, _reducing_gap = Image.get_rendition_specs()
+        formats = formats or default_formats
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if not paths:
+                paths = self.make_jpegs(temp_dir, count, [int(side) for side in size.split('x')])
+
+            for label, gap in [('full decode', None), (f'draft, reducing gap {reducing_gap}', reducing_gap)]:
+                # every mode gets its own process, so peak RSS is not shared between them
+                context = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    jobs = [(path, sizes, formats, gap) for path in paths]
+                    seconds, peak_rss = executor.submit(engine.benchmark, jobs).result()
+
+                self.stdout.write(f'{label}: {statistics.mean(seconds) * 1000:.0f} ms/image '
+                                  f'(median {statistics.median(seconds) * 1000:.0f} ms), '
+                                  f'peak RSS {peak_rss / 1024:.1f} MiB')
+
+    def make_jpegs(self, temp_dir, count, size):
+        paths = []
+        for index in range(count):
+            image = PIL.Image.merge('RGB', [PIL.Image.linear_gradient('L'), PIL.Image.radial_gradient('L'),
+                                            PIL.Image.linear_gradient('L').rotate(90 * index)])
+            path = os.path.join(temp_dir, f'{index}.jpg')
+            image.resize(size).save(path, quality=90)
+            paths.append(path)
+        self.stdout.write(f'made {count} JPEGs of {size[0]}x{size[1]}')
+        return paths
@@ -0,0 +1,71 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mini_pic_wall.batching import apply_async_in_batches
+from mini_pic_wall.cache import bump_versions
+from pictures.models import Image, Rendition
+from pictures.tasks import delete_files
+
+
+class Command(BaseCommand):
+    help = 'Move media files into the sharded layout while the site keeps running'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--grace-period', type=int, default=settings.RESPONSE_CACHE_TIMEOUT,
+                            help='seconds to keep old files for responses and tasks still using their names')
+
+    def handle(self, *args, batch_size, grace_period, **options):
+        self.grace_period = grace_period
+        for model, fields in [(Image, ['uploaded_image', 'thumbnail']), (Rendition, ['file'])]:
+            moved_count = self.shard(model, fields, batch_size)
+            self.stdout.write(self.style.SUCCESS(f'Moved {moved_count} {model._meta.verbose_name} files'))
+
+    # every batch is copied first, then its rows are switched to the copies, and
+    # the old files are deleted after a grace period, so no row points to a missing
+    # file and cached responses or running tasks can still read the old names
+    def shard(self, model, fields, batch_size):
+        moved_count = 0
+        last_pk = 0
+        while batch := list(model.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', *fields)[:batch_size]):
+            last_pk = batch[-1].pk
+
+            moves = []
+            for instance in batch:
+                for field in fields:
+                    file = getattr(instance, field)
+                    if not file: continue
+                    new_name = file.storage.get_sharded_name(file.name)
+                    if new_name != file.name:
+                        self.copy(file.storage, file.name, new_name)
+                        moves.append((instance.pk, field, file.storage, file.name, new_name))
+
+            moved = []
+            with transaction.atomic():
+                for pk, field, storage, old_name, new_name in moves:
+                    # rows changed since they were read keep their new files
+                    if model.objects.filter(pk=pk, **{field: old_name}).update(**{field: new_name}):
+                        moved.append(old_name)
+                    else:
+                        storage.delete(new_name)
+
+            if moved:
+                bump_versions(['all'])
+                apply_async_in_batches(delete_files, moved, settings.DELETION_BATCH_SIZE, countdown=self.grace_period)
+
+            moved_count += len(moved)
+            self.stdout.write(f'{moved_count} {model._meta.verbose_name} files moved, last id {last_pk}')
+        return moved_count
+
+    def copy(self, storage, old_name, new_name):
+        if storage.exists(new_name): return
+
+        try:
+            new_path = storage.path(new_name)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.link(storage.path(old_name), new_path)
+        except (NotImplementedError, OSError):
+            with storage.open(old_name) as file:
+                saved_name = storage.save(new_name, file)
+            assert saved_name == new_name
@@ -0,0 +1,58 @@
+import os
+import time
+from itertools import islice
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pictures.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Make thumbnails of images that have none, rendering them in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_BATCH_SIZE)
+        parser.add_argument('--outdated', action='store_true',
+                            help='also remake thumbnails whose sizes or formats are outdated')
+        parser.add_argument('--checkpoint', help='file keeping the last processed image id to resume from')
+
+    def handle(self, *args, batch_size, outdated, checkpoint, **options):
+        images = Image.objects.without_thumbnail()
+        if outdated:
+            images |= Image.objects.outdated()
+        images = images.filter(pk__gt=self.read_checkpoint(checkpoint)).order_by('pk')
+
+        total_count = images.count()
+        image_pks = images.values_list('pk', flat=True).iterator(chunk_size=batch_size)
+
+        start = time.monotonic()
+        seen_count = made_count = 0
+        while batch := list(islice(image_pks, batch_size)):
+            made_count += len(Image.make_thumbnails_now(batch, replace=outdated))
+            seen_count += len(batch)
+            self.write_checkpoint(checkpoint, batch[-1])
+
+            rate = seen_count / (time.monotonic() - start)
+            self.stdout.write(f'{made_count}/{total_count} thumbnails made, '
+                              f'last image {batch[-1]}, {rate:.1f} images/s')
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(f'Made {made_count} of {seen_count} thumbnails '
+                                             f'in {elapsed:.1f}s ({seen_count / (elapsed or 1):.1f} images/s)'))
+
+    def read_checkpoint(self, checkpoint):
+        if not checkpoint or not os.path.exists(checkpoint): return 0
+
+        with open(checkpoint) as file:
+            last_pk = int(file.read())
+        self.stdout.write(f'resuming after image {last_pk}')
+        return last_pk
+
+    def write_checkpoint(self, checkpoint, last_pk):
+        if not checkpoint: return
+
+        with open(checkpoint + '.tmp', 'w') as file:
+            file.write(str(last_pk))
+        os.replace(checkpoint + '.tmp', checkpoint)
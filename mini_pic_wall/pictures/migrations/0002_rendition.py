@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pictures', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=31)),
+                ('format', models.CharField(max_length=15)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('file', models.ImageField(upload_to='renditions/')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pictures.image')),
+            ],
+            options={
+                'ordering': ['pk'],
+                'default_related_name': '%(model_name)ss',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='rendition',
+            constraint=models.UniqueConstraint(fields=('image', 'name', 'format'), name='unique_image_rendition'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:00
+
+import os
+import re
+from django.db import migrations, models
+
+
+def backfill_sha256(apps, schema_editor):
+    Image = apps.get_model('pictures', 'Image')
+    seen = set()
+    images = []
+    for image in Image.objects.filter(sha256=None).only('pk', 'uploaded_image').iterator(chunk_size=1000):
+        name, _ext = os.path.splitext(os.path.basename(image.uploaded_image.name))
+        if not re.fullmatch(r'[0-9a-f]{64}', name) or name in seen: continue
+        seen.add(name)
+        image.sha256 = name
+        images.append(image)
+    Image.objects.bulk_update(images, ['sha256'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pictures', '0002_rendition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='sha256',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_sha256, migrations.RunPython.noop),
+    ]
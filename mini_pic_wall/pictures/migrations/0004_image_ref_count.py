@@ -0,0 +1,32 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:15
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_references(apps, schema_editor):
+    Image = apps.get_model('pictures', 'Image')
+    Picture = apps.get_model('pictures', 'Picture')
+    ref_counts = (Picture.objects.filter(image=models.OuterRef('pk')).order_by()
+                  .values('image').annotate(count=models.Count('pk')).values('count'))
+    Image.objects.update(ref_count=Coalesce(models.Subquery(ref_counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pictures', '0003_image_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='ref_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('ref_count', 0)), fields=['ref_count'], name='orphan_image_idx'),
+        ),
+    ]
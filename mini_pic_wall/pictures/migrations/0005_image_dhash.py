@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pictures', '0004_image_ref_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='dhash_0',
+            field=models.PositiveIntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='dhash_1',
+            field=models.PositiveIntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='dhash_2',
+            field=models.PositiveIntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='dhash_3',
+            field=models.PositiveIntegerField(db_index=True, editable=False, null=True),
+        ),
+    ]
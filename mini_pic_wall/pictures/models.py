@@ -1,77 +1,361 @@
 import os
-import io
+import time
 import hashlib
-from time import strftime
-import PIL
-from django.db import models, transaction
+import logging
+from collections import Counter
+from django.apps import apps
+from django.db import models, transaction, IntegrityError
+from django.db.models.functions import Coalesce, Greatest
 from django.conf import settings
-from django.core.files import File
-from .tasks import make_image_thumbnail
+from django.core.files.base import ContentFile
+from django.dispatch import Signal
+from mini_pic_wall.batching import add_on_commit, apply_async_in_batches
+from . import engine, filecache
+from .tasks import make_image_thumbnails, delete_orphan_images, delete_files
 
 
-class ImageManager(models.Manager):
-    def create(self, uploaded_image):
-        sha256 = hashlib.sha256()
-        for chunk in uploaded_image.chunks():
-            sha256.update(chunk)
+logger = logging.getLogger(__name__)
 
-        _name, ext = os.path.splitext(uploaded_image.name)
-        sha256_name = sha256.hexdigest() + ext
+thumbnails_created = Signal()
+
+
+class ImageQuerySet(models.QuerySet):
+    def without_thumbnail(self):
+        return self.filter(thumbnail='')
+
+    # images still waiting for their thumbnails are never orphans; ref_count
+    # narrows them down fast, the anti-join keeps a drifted count from deleting
+    # an image that still has pictures
+    def orphans(self):
+        pictures = Picture.objects.filter(image=models.OuterRef('pk'))
+        return self.filter(~models.Exists(pictures), ref_count=0).exclude(thumbnail='')
+
+    # images whose renditions do not match the current sizes and formats;
+    # sizes that grew are not detected, the originals' sizes are not stored
+    def outdated(self):
+        sizes, formats, _reducing_gap = self.model.get_rendition_specs()
+        renditions = Rendition.objects.filter(image=models.OuterRef('pk'))
+
+        stale = ~models.Q(name__in=[name for name, _size in sizes]) | ~models.Q(format__in=formats)
+        for name, (width, height) in sizes:
+            stale |= models.Q(name=name) & (models.Q(width__gt=width) | models.Q(height__gt=height))
 
-        upload_to = self.model.uploaded_image.field.upload_to
-        if not callable(upload_to):
-            filename = os.path.join(strftime(upload_to), sha256_name)
-            same_image = self.filter(uploaded_image=filename).first()
+        outdated = models.Exists(renditions.filter(stale))
+        for format in formats:
+            if format != self.model.thumbnail_format:
+                outdated |= ~models.Exists(renditions.filter(name='thumbnail', format=format))
+        return self.exclude(thumbnail='').filter(outdated | models.Q(dhash_0=None))
+
+    def similar_to(self, dhash, max_distance=None):
+        if max_distance is None:
+            max_distance = settings.SIMILAR_IMAGE_DISTANCE
+        assert max_distance < len(self.model.dhash_fields)
+
+        same_chunk = models.Q()
+        for field, chunk in zip(self.model.dhash_fields, engine.split_dhash(dhash)):
+            same_chunk |= models.Q(**{field: chunk})
+        candidates = self.filter(same_chunk).values_list('pk', *self.model.dhash_fields)
+        similar_pks = [pk for pk, *chunks in candidates
+                       if engine.get_distance(dhash, engine.join_dhash(chunks)) <= max_distance]
+        return self.filter(pk__in=similar_pks)
+
+class ImageManager(models.Manager.from_queryset(ImageQuerySet)):
+    # the closest similar image that also has the same aspect ratio and colors
+    def get_same_looking(self, uploaded_image, dhash):
+        if not engine.is_textured(dhash): return None
+
+        appearance = engine.get_file_appearance(uploaded_image)
+        candidates = self.similar_to(dhash, settings.MERGE_SIMILAR_DISTANCE)
+        for image in sorted(candidates, key=lambda image: engine.get_distance(dhash, image.dhash)):
+            file = image.thumbnail or image.uploaded_image
+            with file.storage.open(file.name) as candidate_file:
+                if not engine.looks_same(appearance, engine.get_file_appearance(candidate_file)): continue
+            same_image = self.select_for_update().filter(pk=image.pk).first()
             if same_image: return same_image
+        return None
+
+    def create(self, uploaded_image):
+        sha256_hash = getattr(uploaded_image, 'sha256', None)
+        if sha256_hash is None:
+            sha256 = hashlib.sha256()
+            for chunk in uploaded_image.chunks():
+                sha256.update(chunk)
+            sha256_hash = sha256.hexdigest()
 
-        uploaded_image.name = sha256_name
-        new_image = super().create(uploaded_image=uploaded_image)
+        # an existing image stays locked until the caller's transaction saves the
+        # picture referencing it, so the orphan collector cannot delete it meanwhile
+        same_image = self.select_for_update().filter(sha256=sha256_hash).first()
+        if same_image: return same_image
+
+        dhash = None
+        if settings.MERGE_SIMILAR_UPLOADS:
+            dhash = engine.get_file_dhash(uploaded_image)
+            uploaded_image.seek(0)
+            similar_image = self.get_same_looking(uploaded_image, dhash)
+            uploaded_image.seek(0)
+            if similar_image: return similar_image
+
+        _name, ext = os.path.splitext(uploaded_image.name)
+        uploaded_image.name = sha256_hash + ext
+        new_image = self.model(uploaded_image=uploaded_image, sha256=sha256_hash, dhash=dhash)
+        try:
+            with transaction.atomic(using=self.db):
+                new_image.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            # the same bytes were uploaded concurrently and stored first; storages
+            # with content addressed names may have given both the same file
+            same_image = self.select_for_update().get(sha256=sha256_hash)
+            if new_image.uploaded_image and new_image.uploaded_image.name != same_image.uploaded_image.name:
+                new_image.uploaded_image.storage.delete(new_image.uploaded_image.name)
+            return same_image
         new_image.make_thumbnail_on_commit()
         return new_image
 
 class Image(models.Model):
     uploaded_image = models.ImageField(upload_to='images/', unique=True)
     thumbnail = models.ImageField(upload_to='thumbnails/', blank=True)
+    sha256 = models.CharField(max_length=64, unique=True, null=True, editable=False)
+    ref_count = models.PositiveIntegerField(default=0, editable=False)
+    # dhash split into 16-bit chunks, each indexed for similar image lookups
+    dhash_0 = models.PositiveIntegerField(null=True, db_index=True, editable=False)
+    dhash_1 = models.PositiveIntegerField(null=True, db_index=True, editable=False)
+    dhash_2 = models.PositiveIntegerField(null=True, db_index=True, editable=False)
+    dhash_3 = models.PositiveIntegerField(null=True, db_index=True, editable=False)
+    dhash_fields = ['dhash_0', 'dhash_1', 'dhash_2', 'dhash_3']
     thumbnail_size = (128, 128)
     thumbnail_format = 'png'
+    rendition_sizes = {'medium': (512, 512), 'large': (1024, 1024)}
+    rendition_formats = ['avif', 'webp']
 
     objects = ImageManager()
 
     class Meta:
         ordering = ['pk']
+        indexes = [
+            models.Index(fields=['ref_count'], condition=models.Q(ref_count=0), name='orphan_image_idx'),
+        ]
+
+    @property
+    def dhash(self):
+        chunks = [getattr(self, field) for field in self.dhash_fields]
+        return None if None in chunks else engine.join_dhash(chunks)
+
+    @dhash.setter
+    def dhash(self, dhash):
+        chunks = [None] * len(self.dhash_fields) if dhash is None else engine.split_dhash(dhash)
+        for field, chunk in zip(self.dhash_fields, chunks):
+            setattr(self, field, chunk)
 
     def make_thumbnail_on_commit(self):
-        transaction.on_commit(self.make_thumbnail_async)
+        add_on_commit(Image.make_thumbnails_async, self.pk)
+
+    @classmethod
+    def change_ref_counts(cls, image_pks, delta=1):
+        pks_by_count = {}
+        for image_pk, count in Counter(image_pks).items():
+            pks_by_count.setdefault(count, []).append(image_pk)
+        for count, pks in pks_by_count.items():
+            cls.objects.filter(pk__in=pks).update(ref_count=Greatest(models.F('ref_count') + count * delta, 0))
+
+    @staticmethod
+    def make_thumbnails_async(image_pks):
+        apply_async_in_batches(make_image_thumbnails, image_pks, settings.THUMBNAIL_BATCH_SIZE)
+
+    @staticmethod
+    def delete_orphans_async(image_pks):
+        apply_async_in_batches(delete_orphan_images, sorted(set(image_pks)), settings.DELETION_BATCH_SIZE)
+
+    @staticmethod
+    def delete_files_async(names):
+        apply_async_in_batches(delete_files, names, settings.DELETION_BATCH_SIZE)
+
+    # files with the same bytes may share a content addressed name, so a name is
+    # still in use while any file field refers to it
+    @staticmethod
+    def get_referenced_names(names):
+        referenced = set()
+        for model in apps.get_models():
+            for field in model._meta.concrete_fields:
+                if not isinstance(field, models.FileField): continue
+                files = model._default_manager.filter(**{f'{field.attname}__in': names})
+                referenced.update(files.values_list(field.attname, flat=True))
+        return referenced
+
+    @classmethod
+    def delete_orphans_now(cls, image_pks):
+        orphans = cls.objects.orphans().filter(pk__in=image_pks)
+        with transaction.atomic():
+            orphan_pks = list(orphans.select_for_update().values_list('pk', flat=True))
+            _count, deleted = cls.objects.filter(pk__in=orphan_pks).delete()
+        return deleted.get(cls._meta.label, 0)
 
-    def make_thumbnail_async(self):
-        make_image_thumbnail.apply_async(args=(self.pk,), ignore_result=True)
+    @classmethod
+    def collect_orphans(cls, batch_size=None):
+        batch_size = batch_size or settings.DELETION_BATCH_SIZE
+        start = time.monotonic()
+
+        fixed_count = cls.reconcile_ref_counts(batch_size)
+        deleted_count = 0
+        last_pk = 0
+        while True:
+            orphans = cls.objects.orphans().filter(pk__gt=last_pk).order_by('pk')
+            batch = list(orphans.values_list('pk', flat=True)[:batch_size])
+            if not batch: break
+            deleted_count += cls.delete_orphans_now(batch)
+            last_pk = batch[-1]
+
+        logger.info('Collected %d orphan images in %.2fs, fixed %d reference counts',
+                    deleted_count, time.monotonic() - start, fixed_count)
+        return deleted_count
+
+    # recounts pictures of every image, fixing counts left wrong by inserts and
+    # deletes that bypass signals, like bulk_create or QuerySet.delete()
+    @classmethod
+    def reconcile_ref_counts(cls, batch_size):
+        pictures = Picture.objects.filter(image=models.OuterRef('pk')).order_by()
+        picture_count = Coalesce(models.Subquery(pictures.values('image').annotate(
+            count=models.Count('pk')).values('count')), 0)
+
+        fixed_count = 0
+        last_pk = 0
+        while batch := list(cls.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]):
+            fixed_count += (cls.objects.filter(pk__in=batch).exclude(ref_count=picture_count)
+                            .update(ref_count=picture_count))
+            last_pk = batch[-1]
+        return fixed_count
+
+    # the originals stay in the file cache until the block using them ends
+    @classmethod
+    def get_uploaded_image_paths(cls, images):
+        storage = cls._meta.get_field('uploaded_image').storage
+        return filecache.get_paths(storage, [image.uploaded_image.name for image in images])
+
+    @classmethod
+    def get_rendition_specs(cls):
+        sizes = [('thumbnail', cls.thumbnail_size), *cls.rendition_sizes.items()]
+        formats = [cls.thumbnail_format, *engine.get_supported_formats(cls.rendition_formats)]
+        return sizes, formats, settings.THUMBNAIL_REDUCING_GAP
+
+    @classmethod
+    def make_thumbnails_now(cls, image_pks, replace=False):
+        images = [image for image in cls.objects.in_bulk(image_pks).values() if replace or not image.thumbnail]
+        old_thumbnails = {image.pk: image.thumbnail.name for image in images}
+        with cls.get_uploaded_image_paths(images) as paths:
+            results = engine.render_many([(path, *cls.get_rendition_specs()) for path in paths])
+
+        made_images = []
+        renditions = []
+        for image, result in zip(images, results):
+            if isinstance(result, Exception):
+                logger.error('Could not make thumbnail for image %s', image.pk, exc_info=result)
+                continue
+            image.dhash = result.dhash
+            renditions += image.save_renderings(result.renderings)
+            made_images.append(image)
+
+        with transaction.atomic():
+            made_images = cls.lock_unchanged(made_images, old_thumbnails, renditions)
+            renditions = [rendition for rendition in renditions if rendition.image in made_images]
+            if replace:
+                Rendition.objects.filter(image__in=made_images).delete()
+                for image in made_images:
+                    if old_thumbnails[image.pk]: add_on_commit(cls.delete_files_async, old_thumbnails[image.pk])
+            cls.objects.bulk_update(made_images, ['thumbnail', *cls.dhash_fields])
+            Rendition.objects.bulk_create(renditions)
+            thumbnails_created.send(sender=cls, images=made_images)
+        return made_images
 
     def make_thumbnail_now(self, save=True):
-        if self.thumbnail: return
+        if self.thumbnail: return []
+
+        with self.get_uploaded_image_paths([self]) as [path]:
+            result = engine.render(path, *self.get_rendition_specs())
+        self.dhash = result.dhash
+        renditions = self.save_renderings(result.renderings)
+
+        if save:
+            with transaction.atomic():
+                if not self.lock_unchanged([self], {self.pk: ''}, renditions): return []
+                self.save(update_fields=['thumbnail', *self.dhash_fields])
+                Rendition.objects.bulk_create(renditions)
+                thumbnails_created.send(sender=Image, images=[self])
+        return renditions
+
+    # locks the images whose thumbnails are still the ones they were rendered
+    # for; renderings of the others, made or being made by another worker
+    # meanwhile, are deleted when the transaction commits
+    @classmethod
+    def lock_unchanged(cls, images, old_thumbnails, renditions):
+        locked = cls.objects.select_for_update(skip_locked=True).filter(pk__in=[image.pk for image in images])
+        thumbnails = dict(locked.values_list('pk', 'thumbnail'))
+        unchanged = [image for image in images if thumbnails.get(image.pk) == old_thumbnails[image.pk]]
 
-        with PIL.Image.open(self.uploaded_image.path) as image:
-            image.thumbnail(size=self.thumbnail_size)
+        for image in images:
+            if image in unchanged: continue
+            add_on_commit(cls.delete_files_async, image.thumbnail.name)
+            for rendition in renditions:
+                if rendition.image == image: add_on_commit(cls.delete_files_async, rendition.file.name)
+        return unchanged
 
-            thumbnail_bytes = io.BytesIO()
-            image.save(thumbnail_bytes, format=self.thumbnail_format)
+    def save_renderings(self, renderings):
+        renditions = []
+        for rendering in renderings:
+            content = ContentFile(rendering.content, name=rendering.file_name)
+            if rendering.name == 'thumbnail' and rendering.format == self.thumbnail_format:
+                self.thumbnail.save(name=rendering.file_name, content=content, save=False)
+            else:
+                rendition = Rendition(image=self, name=rendering.name, format=rendering.format,
+                                      width=rendering.width, height=rendering.height)
+                rendition.file.save(name=rendering.file_name, content=content, save=False)
+                renditions.append(rendition)
+        return renditions
 
-            thumbnail_bytes.seek(0)
-            sha256_hash = hashlib.sha256(thumbnail_bytes.read()).hexdigest()
-            sha256_name = sha256_hash + '.' + self.thumbnail_format
+    def get_thumbnail(self, formats=()):
+        if not formats: return self.thumbnail
 
-            thumbnail_bytes.seek(0)
-            thumbnail_file = File(thumbnail_bytes, name=sha256_name)
-            self.thumbnail.save(name=sha256_name, content=thumbnail_file, save=save)
+        thumbnails = {rendition.format: rendition.file for rendition in self.renditions.all()
+                      if rendition.name == 'thumbnail'}
+        for format in formats:
+            if format in thumbnails: return thumbnails[format]
+        return self.thumbnail
 
     def __str__(self):
         return os.path.basename(self.uploaded_image.name)
 
 
+class Rendition(models.Model):
+    image = models.ForeignKey(Image, on_delete=models.CASCADE)
+    name = models.CharField(max_length=31)
+    format = models.CharField(max_length=15)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    file = models.ImageField(upload_to='renditions/')
+
+    class Meta:
+        default_related_name = '%(model_name)ss'
+        ordering = ['pk']
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'name', 'format'], name='unique_image_rendition'),
+        ]
+
+    def __str__(self):
+        return f'{self.image} {self.name}.{self.format}'
+
+
+class PictureQuerySet(models.QuerySet):
+    def with_thumbnails(self):
+        thumbnails = Rendition.objects.filter(name='thumbnail')
+        return (self.select_related('image')
+                .prefetch_related(models.Prefetch('image__renditions', queryset=thumbnails)))
+
+
 class Picture(models.Model):
     name = models.CharField(max_length=255)
     image = models.ForeignKey(Image, on_delete=models.CASCADE)
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
+    objects = PictureQuerySet.as_manager()
+
     class Meta:
         default_related_name = '%(model_name)ss'
         ordering = ['pk']
@@ -0,0 +1,91 @@
+import mimetypes
+import posixpath
+import tempfile
+from urllib.parse import urljoin
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+from django.utils.functional import cached_property
+from mini_pic_wall.media import content_addressed_name
+from .storage import ShardedStorageMixin, SignedURLMixin
+
+
+# stores media in an S3 compatible bucket (AWS, MinIO, ...); files larger than
+# the chunk size are streamed in multipart uploads and downloads
+@deconstructible
+class S3Storage(Storage):
+    def __init__(self, bucket=None, endpoint_url=None, access_key=None, secret_key=None, region=None,
+                 base_url=None, chunk_size=8 * 1024 * 1024):
+        self.bucket = bucket or settings.S3_BUCKET
+        self.endpoint_url = endpoint_url or settings.S3_ENDPOINT_URL
+        self.access_key = access_key or settings.S3_ACCESS_KEY
+        self.secret_key = secret_key or settings.S3_SECRET_KEY
+        self.region = region or settings.S3_REGION
+        self.base_url = base_url or settings.S3_BASE_URL or settings.MEDIA_URL
+        self.transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size)
+
+    @cached_property
+    def client(self):
+        return boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region,
+                            aws_access_key_id=self.access_key, aws_secret_access_key=self.secret_key)
+
+    def _open(self, name, mode='rb'):
+        file = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        self.client.download_fileobj(self.bucket, name, file, Config=self.transfer_config)
+        file.seek(0)
+        return File(file, name=name)
+
+    # a content addressed name always holds the same bytes, so saving it again
+    # overwrites the file in place instead of storing a renamed copy
+    def get_available_name(self, name, max_length=None):
+        if content_addressed_name.fullmatch(posixpath.basename(name)):
+            return name
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        extra_args = {'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+        # the bucket serves media itself, so it sends the caching headers nginx would
+        if content_addressed_name.fullmatch(posixpath.basename(name)):
+            extra_args['CacheControl'] = 'public, max-age=31536000, immutable'
+        self.client.upload_fileobj(content, self.bucket, name, ExtraArgs=extra_args, Config=self.transfer_config)
+        return name
+
+    def head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return None
+            raise
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def size(self, name):
+        head = self.head(name)
+        if head is None: raise FileNotFoundError(name)
+        return head['ContentLength']
+
+    def get_modified_time(self, name):
+        head = self.head(name)
+        if head is None: raise FileNotFoundError(name)
+        return head['LastModified']
+
+    def url(self, name):
+        return urljoin(self.base_url, filepath_to_uri(name))
+
+
+# signatures are only checked by a proxy or CDN with nginx's secure_link in front
+# of the bucket, S3 itself ignores them
+class ShardedS3Storage(SignedURLMixin, ShardedStorageMixin, S3Storage):
+    pass
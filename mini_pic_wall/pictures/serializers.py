@@ -1,11 +1,41 @@
-from django.db.models import F
+import os
+from django.db import transaction
+from django.db.models import F, prefetch_related_objects
 from rest_framework import serializers
+from mini_pic_wall.cache import bump_versions_on_commit
 from users.serializers import HyperlinkedUserSerializer
 from . import models
 
 
+def get_accepted_formats(request, formats):
+    accepted = {}
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _sep, value = param.partition('=')
+            if key.strip() == 'q':
+                try: quality = float(value)
+                except ValueError: quality = 0.0
+        accepted[media_type.lower()] = quality
+
+    formats = [format for format in formats if accepted.get('image/' + format, 0) > 0]
+    return sorted(formats, key=lambda format: accepted['image/' + format], reverse=True)
+
+
+class ThumbnailField(serializers.ImageField):
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, image):
+        request = self.context.get('request', None)
+        formats = [] if request is None else get_accepted_formats(request, image.rendition_formats)
+        return super().to_representation(image.get_thumbnail(formats))
+
+
 class HyperlinkedPictureSerializer(serializers.HyperlinkedModelSerializer):
-    thumbnail = serializers.ImageField(source='image_thumbnail')
+    thumbnail = ThumbnailField(source='image')
 
     class Meta:
         model = models.Picture
@@ -18,17 +48,69 @@ class HyperlinkedPictureSerializer(serializers.HyperlinkedModelSerializer):
         return super().__init__(*args, **kwargs)
 
 
+class RenditionSerializer(serializers.ModelSerializer):
+    url = serializers.ImageField(source='file')
+
+    class Meta:
+        model = models.Rendition
+        fields = ['name', 'format', 'width', 'height', 'url']
+
+
 class PictureSerializer(serializers.ModelSerializer):
-    image = serializers.ImageField(source='image.uploaded_image')
-    thumbnail = serializers.ImageField(source='image.thumbnail', read_only=True)
+    image = serializers.ImageField(source='image.uploaded_image', required=False)
+    sha256 = serializers.RegexField(r'^[0-9a-f]{64}$', write_only=True, required=False)
+    thumbnail = ThumbnailField(source='image')
+    renditions = RenditionSerializer(source='image.renditions', many=True, read_only=True)
     collages = serializers.HyperlinkedIdentityField(view_name='picture-collages')
     owner = HyperlinkedUserSerializer(read_only=True)
 
     class Meta:
         model = models.Picture
-        fields = ['name', 'image', 'thumbnail', 'collages', 'owner']
+        fields = ['name', 'image', 'sha256', 'thumbnail', 'renditions', 'collages', 'owner']
+
+    def validate(self, data):
+        sha256_hash = data.pop('sha256', None)
+        if 'image' in data: return data
+        if sha256_hash is None:
+            raise serializers.ValidationError('Either image or sha256 is required')
+
+        same_image = models.Image.objects.filter(sha256=sha256_hash).first()
+        if same_image is None:
+            raise serializers.ValidationError({'sha256': 'No image with this hash, upload the image instead'})
+        data['same_image'] = same_image
+        return data
 
+    @transaction.atomic
     def create(self, validated_data):
-        uploaded_image = validated_data.pop('image')['uploaded_image']
-        image = models.Image.objects.create(uploaded_image=uploaded_image)
+        image = validated_data.pop('same_image', None)
+        if image is not None:
+            image = models.Image.objects.select_for_update().filter(pk=image.pk).first()
+            if image is None:
+                raise serializers.ValidationError({'sha256': 'No image with this hash, upload the image instead'})
+        else:
+            uploaded_image = validated_data.pop('image')['uploaded_image']
+            image = models.Image.objects.create(uploaded_image=uploaded_image)
         return models.Picture.objects.create(image=image, **validated_data)
+
+
+class BulkPictureSerializer(serializers.Serializer):
+    images = serializers.ListField(child=serializers.ImageField(), allow_empty=False, max_length=100)
+
+    @transaction.atomic
+    def create(self, validated_data):
+        owner = validated_data['owner']
+        pictures = []
+        for uploaded_image in validated_data['images']:
+            name, _ext = os.path.splitext(os.path.basename(uploaded_image.name))
+            image = models.Image.objects.create(uploaded_image=uploaded_image)
+            pictures.append(models.Picture(name=name, image=image, owner=owner))
+
+        pictures = models.Picture.objects.bulk_create(pictures)
+        models.Image.change_ref_counts([picture.image_id for picture in pictures])
+        bump_versions_on_commit(['pictures', f'user:{owner.username}'])
+        return pictures
+
+    def to_representation(self, pictures):
+        prefetch_related_objects(pictures, 'image__renditions')
+        serializer = HyperlinkedPictureSerializer(pictures, many=True, context=self.context)
+        return {'pictures': serializer.data}
@@ -1,12 +1,19 @@
-from django.db.models.signals import pre_delete, post_delete
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
+from mini_pic_wall.batching import add_on_commit
+from mini_pic_wall.cache import bump_versions_on_commit
 from . import models
 
 
+@receiver(post_save, sender=models.Picture, dispatch_uid="reference_image")
+def reference_image(sender, instance, created, **kwargs):
+    if created:
+        models.Image.change_ref_counts([instance.image_id])
+
 @receiver(post_delete, sender=models.Picture, dispatch_uid="delete_unreferenced_image")
 def delete_unreferenced_image(sender, instance, **kwargs):
-    if instance.image.pictures.count() == 0:
-        instance.image.delete()
+    models.Image.change_ref_counts([instance.image_id], delta=-1)
+    add_on_commit(models.Image.delete_orphans_async, instance.image_id)
 
 @receiver(pre_delete, sender=models.Image, dispatch_uid="check_image_thumbnail")
 def check_image_thumbnail(sender, instance, **kwargs):
@@ -15,5 +22,41 @@ def check_image_thumbnail(sender, instance, **kwargs):
 
 @receiver(post_delete, sender=models.Image, dispatch_uid="delete_image_files")
 def delete_image_files(sender, instance, **kwargs):
-    instance.uploaded_image.delete(save=False)
-    instance.thumbnail.delete(save=False)
+    for file in [instance.uploaded_image, instance.thumbnail]:
+        if file: add_on_commit(models.Image.delete_files_async, file.name)
+
+@receiver(post_delete, sender=models.Rendition, dispatch_uid="delete_rendition_file")
+def delete_rendition_file(sender, instance, **kwargs):
+    add_on_commit(models.Image.delete_files_async, instance.file.name)
+
+
+def get_picture_scopes(picture):
+    return ['pictures', f'picture:{picture.pk}', f'user:{picture.owner.username}']
+
+@receiver(post_save, sender=models.Picture, dispatch_uid="invalidate_saved_picture")
+def invalidate_saved_picture(sender, instance, **kwargs):
+    bump_versions_on_commit(get_picture_scopes(instance))
+
+@receiver(pre_delete, sender=models.Picture, dispatch_uid="collect_picture_collages")
+def collect_picture_collages(sender, instance, **kwargs):
+    instance._collage_pks = list(instance.collages.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=models.Picture, dispatch_uid="invalidate_deleted_picture")
+def invalidate_deleted_picture(sender, instance, **kwargs):
+    collage_scopes = [f'collage:{collage_pk}' for collage_pk in instance._collage_pks]
+    bump_versions_on_commit(get_picture_scopes(instance) + collage_scopes)
+
+@receiver(models.thumbnails_created, dispatch_uid="invalidate_image_pictures")
+def invalidate_image_pictures(sender, images, **kwargs):
+    if not images: return
+
+    scopes = ['pictures']
+    pictures = models.Picture.objects.filter(image__in=images)
+    for picture_pk, owner_username in pictures.values_list('pk', 'owner__username'):
+        scopes += [f'picture:{picture_pk}', f'user:{owner_username}']
+
+    attached_pictures = models.Picture.collages.through.objects.filter(picture__image__in=images)
+    for collage_pk in attached_pictures.values_list('collage_id', flat=True):
+        scopes.append(f'collage:{collage_pk}')
+
+    bump_versions_on_commit(scopes)
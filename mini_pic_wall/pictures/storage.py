@@ -0,0 +1,34 @@
+import re
+import posixpath
+from django.core.files.storage import FileSystemStorage
+from mini_pic_wall.media import sign_url
+
+
+# keeps content addressed files out of huge flat directories by nesting
+# them under prefixes of their hashes: images/ab/cd/abcd...png
+class ShardedStorageMixin:
+    shard_depth = 2
+    shard_width = 2
+
+    def get_shards(self, basename):
+        shard_length = self.shard_depth * self.shard_width
+        if not re.match(rf'[0-9a-f]{{{shard_length}}}', basename): return []
+        return [basename[start:start + self.shard_width] for start in range(0, shard_length, self.shard_width)]
+
+    def get_sharded_name(self, name):
+        dirname, basename = posixpath.split(name)
+        shards = self.get_shards(basename)
+        if not shards or dirname.split('/')[-len(shards):] == shards: return name
+        return posixpath.join(dirname, *shards, basename)
+
+    def generate_filename(self, filename):
+        return super().generate_filename(self.get_sharded_name(filename))
+
+
+class SignedURLMixin:
+    def url(self, name):
+        return sign_url(super().url(name))
+
+
+class ShardedFileSystemStorage(SignedURLMixin, ShardedStorageMixin, FileSystemStorage):
+    pass
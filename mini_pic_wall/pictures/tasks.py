@@ -1,4 +1,5 @@
 from celery import shared_task
+from django.core.files.storage import default_storage
 from . import models
 
 
@@ -6,3 +7,21 @@ from . import models
 def make_image_thumbnail(image_pk):
     image = models.Image.objects.get(pk=image_pk)
     image.make_thumbnail_now(save=True)
+
+@shared_task(ignore_result=True)
+def make_image_thumbnails(image_pks):
+    models.Image.make_thumbnails_now(image_pks)
+
+@shared_task(ignore_result=True)
+def delete_orphan_images(image_pks):
+    models.Image.delete_orphans_now(image_pks)
+
+@shared_task(ignore_result=True)
+def collect_orphan_images():
+    models.Image.collect_orphans()
+
+@shared_task(ignore_result=True)
+def delete_files(names):
+    referenced = models.Image.get_referenced_names(names)
+    for name in names:
+        if name not in referenced: default_storage.delete(name)
@@ -1,37 +1,72 @@
 from django.db import models
 from django.urls import resolve
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, InMemoryStorage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.reverse import reverse
+from django.core.cache import cache
+from django.core.management import call_command
 from rest_framework import test
+from django.test import TestCase, override_settings
 from collages.models import Collage
-from .models import Image, Picture
-from PIL import Image as PilImage
+from .models import Image, Picture, Rendition
+from .s3storage import S3Storage, ShardedS3Storage
+from .uploadhandlers import TemporaryFileUploadHandler
+from . import engine, filecache, tasks
+from PIL import Image as PilImage, ImageOps
+from PIL.JpegImagePlugin import JpegImageFile
 import io
+import os
+import base64
+import hashlib
+import tempfile
+from datetime import datetime, timezone
+from unittest import mock
+from botocore.exceptions import ClientError
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 
-def make_image_bytes():
+media_root = tempfile.TemporaryDirectory()
+override_media_root = override_settings(MEDIA_ROOT=media_root.name)
+
+
+def make_image_bytes(size=(16, 16)):
     image_bytes = io.BytesIO()
-    image = PilImage.new('RGBA', size=(16, 16), color=(95, 0, 0))
+    image = PilImage.new('RGBA', size=size, color=(95, 0, 0))
     image.save(image_bytes, 'png')
     image_bytes.name = 'test.png'
     image_bytes.seek(0)
     return image_bytes
 
+def make_pattern_image_bytes(size=(256, 256), angle=0, format='png'):
+    image_bytes = io.BytesIO()
+    image = PilImage.effect_mandelbrot((256, 256), (-2, -1.5, 1, 1.5), 100).rotate(angle).resize(size).convert('RGB')
+    image.save(image_bytes, format)
+    image_bytes.name = f'pattern.{format}'
+    image_bytes.seek(0)
+    return image_bytes
+
+def make_image(size=(16, 16)):
+    image = SimpleUploadedFile(name='test_image.png', content=make_image_bytes(size).read(),
+                               content_type='image/png')
+    return models.Manager.create(Image.objects, uploaded_image=image)
+
 def make_picture(name='picture name', owner=None):
     if owner is None:
         owner = User.objects.create(username='user_name')
 
-    image = SimpleUploadedFile(name='test_image.png', content=make_image_bytes().read(),
-                               content_type='image/png')
-    image = models.Manager.create(Image.objects, uploaded_image=image)
+    image = make_image()
 
     return Picture.objects.create(name=name, image=image, owner=owner)
 
 
+@override_media_root
 class PictureViewAPITestCase(test.APITestCase):
     def setUp(self):
         self.factory = test.APIRequestFactory()
+        cache.clear()
 
     def test_list_pictures(self):
         user1 = User.objects.create(username='user_name_1')
@@ -44,7 +79,7 @@ class PictureViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('picture-detail', request=request, args=[picture1.pk]))
         self.assertEqual(response.data['results'][0]['name'], picture1.name)
@@ -54,6 +89,20 @@ class PictureViewAPITestCase(test.APITestCase):
         self.assertEqual(response.data['results'][1]['name'], picture2.name)
         self.assertIn('thumbnail', response.data['results'][1])
 
+    def test_list_pictures_with_accepted_thumbnail_format(self):
+        picture = make_picture()
+        picture.image.make_thumbnail_now()
+
+        url = reverse('picture-list')
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertTrue(response.data['results'][0]['thumbnail'].endswith('.png'))
+
+        response = self.client.get(url, HTTP_ACCEPT='application/json, image/webp;q=0.9')
+        self.assertTrue(response.data['results'][0]['thumbnail'].endswith('.webp'))
+
+        response = self.client.get(url, HTTP_ACCEPT='application/json, image/webp;q=0')
+        self.assertTrue(response.data['results'][0]['thumbnail'].endswith('.png'))
+
     def test_retrieve_picture(self):
         picture = make_picture()
 
@@ -66,12 +115,26 @@ class PictureViewAPITestCase(test.APITestCase):
         self.assertEqual(response.data['image'],
                          request.build_absolute_uri(picture.image.uploaded_image.url))
         self.assertIn('thumbnail', response.data)
+        self.assertEqual(response.data['renditions'], [])
         self.assertEqual(response.data['collages'],
                          reverse('picture-collages', request=request, args=[picture.pk]))
         self.assertEqual(response.data['owner']['url'],
                          reverse('user-detail', request=request, args=[picture.owner.username]))
         self.assertEqual(response.data['owner']['username'], picture.owner.username)
 
+    @override_settings(MEDIA_URL_SIGNING_KEY='key', MEDIA_URL_LIFETIME=100)
+    def test_retrieve_picture_with_signed_urls(self):
+        picture = make_picture()
+        picture.image.make_thumbnail_now()
+
+        with mock.patch('time.time', return_value=1000):
+            response = self.client.get(reverse('picture-detail', args=[picture.pk]))
+
+        path = '/media/' + picture.image.uploaded_image.name
+        signature = base64.urlsafe_b64encode(hashlib.md5(f'1200{path} key'.encode()).digest()).decode().rstrip('=')
+        self.assertEqual(response.data['image'], f'http://testserver{path}?md5={signature}&expires=1200')
+        self.assertRegex(response.data['thumbnail'], r'\?md5=[\w-]{22}&expires=1200$')
+
     def test_list_picture_collages(self):
         picture = make_picture()
         collage1 = Collage.objects.create(name='collage1', owner=picture.owner)
@@ -83,7 +146,7 @@ class PictureViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request, pk=picture.pk)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('collage-detail', request=request, args=[collage1.pk]))
         self.assertEqual(response.data['results'][0]['name'], collage1.name)
@@ -96,7 +159,7 @@ class PictureViewAPITestCase(test.APITestCase):
         picture = make_picture(owner=user)
         image = picture.image
         image.thumbnail.name = image.uploaded_image.name
-        image.save()
+        image.save(update_fields=['thumbnail'])
 
         url = reverse('picture-detail', args=[picture.pk])
         self.client.force_authenticate(user=user)
@@ -104,3 +167,620 @@ class PictureViewAPITestCase(test.APITestCase):
 
         self.assertEqual(response.status_code, 204)
         self.assertEqual(Picture.objects.count(), 0)
+
+    def test_image_ref_count(self):
+        user = User.objects.create(username='user_name')
+        picture = make_picture(owner=user)
+        same_picture = Picture.objects.create(name='same', image=picture.image, owner=user)
+        picture.image.refresh_from_db()
+        self.assertEqual(picture.image.ref_count, 2)
+
+        picture.delete()
+        picture.image.refresh_from_db()
+        self.assertEqual(picture.image.ref_count, 1)
+
+        same_picture.name = 'renamed'
+        same_picture.save()
+        same_picture.delete()
+        picture.image.refresh_from_db()
+        self.assertEqual(picture.image.ref_count, 0)
+
+    def test_list_similar_pictures(self):
+        user = User.objects.create(username='user_name')
+        pictures = []
+        for name, image_bytes in [('original', make_pattern_image_bytes()),
+                                  ('resized', make_pattern_image_bytes(size=(128, 128), format='jpeg')),
+                                  ('rotated', make_pattern_image_bytes(angle=90))]:
+            image = Image.objects.create(uploaded_image=SimpleUploadedFile(image_bytes.name, image_bytes.read()))
+            image.make_thumbnail_now()
+            pictures.append(Picture.objects.create(name=name, image=image, owner=user))
+
+        response = self.client.get(reverse('picture-similar', args=[pictures[0].pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([picture['name'] for picture in response.data['results']], ['resized'])
+        self.assertEqual(self.client.get(reverse('picture-similar', args=[0])).status_code, 404)
+
+    def test_delete_picture_deletes_orphan_image_on_commit(self):
+        user = User.objects.create(username='user_name')
+        pictures = [make_picture(owner=user), make_picture(owner=user)]
+
+        self.client.force_authenticate(user=user)
+        with mock.patch('pictures.models.delete_orphan_images') as delete_orphan_images:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete(reverse('picture-detail', args=[pictures[0].pk]))
+                user.delete()
+
+        self.assertEqual(delete_orphan_images.apply_async.call_args_list, [
+            mock.call(args=([pictures[0].image_id, pictures[1].image_id],), ignore_result=True),
+        ])
+
+
+@override_media_root
+class ImageTestCase(TestCase):
+    def test_create_same_image(self):
+        content = make_image_bytes(size=(32, 32)).read()
+        image = Image.objects.create(uploaded_image=SimpleUploadedFile('a.png', content))
+        same_image = Image.objects.create(uploaded_image=SimpleUploadedFile('b.png', content))
+
+        self.assertEqual(image.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(same_image, image)
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_create_same_image_concurrently(self):
+        content = make_image_bytes(size=(37, 29)).read()
+        image = Image.objects.create(uploaded_image=SimpleUploadedFile('a.png', content))
+        image_dir = os.path.dirname(image.uploaded_image.path)
+
+        # the other upload is not seen by the lookup, only by the unique constraint
+        with mock.patch.object(type(Image.objects), 'filter', return_value=Image.objects.none()):
+            same_image = Image.objects.create(uploaded_image=SimpleUploadedFile('b.png', content))
+
+        self.assertEqual(same_image, image)
+        self.assertEqual(Image.objects.count(), 1)
+        self.assertEqual(os.listdir(image_dir), [os.path.basename(image.uploaded_image.name)])
+
+    def test_make_thumbnail(self):
+        image = make_image(size=(600, 300))
+        image.make_thumbnail_now()
+
+        image.refresh_from_db()
+        self.assertTrue(image.thumbnail.name.endswith('.png'))
+        with PilImage.open(image.thumbnail.path) as thumbnail:
+            self.assertEqual(thumbnail.size, (128, 64))
+
+        rendition = image.renditions.get(name='medium', format='png')
+        self.assertEqual((rendition.width, rendition.height), (512, 256))
+        with PilImage.open(rendition.file.path) as rendition_image:
+            self.assertEqual(rendition_image.size, (512, 256))
+
+    def test_make_thumbnail_once(self):
+        image = make_image()
+        image.make_thumbnail_now()
+        thumbnail_name = image.thumbnail.name
+
+        self.assertEqual(image.make_thumbnail_now(), [])
+        image.refresh_from_db()
+        self.assertEqual(image.thumbnail.name, thumbnail_name)
+        self.assertEqual(image.renditions.exclude(name='thumbnail').count(), 0)
+
+    @override_settings(THUMBNAIL_BATCH_SIZE=2)
+    def test_make_thumbnails_on_commit(self):
+        with mock.patch('pictures.models.make_image_thumbnails') as make_image_thumbnails:
+            with self.captureOnCommitCallbacks(execute=True):
+                images = [Image.objects.create(uploaded_image=SimpleUploadedFile(
+                    name='test.png', content=make_image_bytes(size=(50 + i, 50)).read())) for i in range(3)]
+
+        self.assertEqual(make_image_thumbnails.apply_async.call_args_list, [
+            mock.call(args=([images[0].pk, images[1].pk],), ignore_result=True),
+            mock.call(args=([images[2].pk],), ignore_result=True),
+        ])
+
+    def test_make_thumbnails_now(self):
+        images = [make_image(size=(600, 300)), make_image(size=(16, 16))]
+        images[1].make_thumbnail_now()
+
+        made_images = Image.make_thumbnails_now([image.pk for image in images] + [0])
+
+        self.assertEqual(made_images, [images[0]])
+        images[0].refresh_from_db()
+        self.assertTrue(images[0].thumbnail)
+        self.assertTrue(images[0].renditions.filter(name='medium').exists())
+
+    def test_make_thumbnails_made_meanwhile_by_another_worker(self):
+        images = [make_image(size=(300, 200)), make_image(size=(200, 300))]
+        render_many = engine.render_many
+
+        def render_many_while_another_worker_renders(jobs):
+            Image.objects.get(pk=images[0].pk).make_thumbnail_now()
+            return render_many(jobs)
+
+        with mock.patch.object(engine, 'render_many', render_many_while_another_worker_renders), \
+             mock.patch('pictures.models.delete_files') as delete_files:
+            with self.captureOnCommitCallbacks(execute=True):
+                made_images = Image.make_thumbnails_now([image.pk for image in images])
+
+        self.assertEqual(made_images, [images[1]])
+        self.assertEqual(Rendition.objects.filter(image=images[0]).count(),
+                         Rendition.objects.filter(image=images[1]).count())
+        dropped_names = delete_files.apply_async.call_args.kwargs['args'][0]
+        self.assertEqual(len(dropped_names), 1 + Rendition.objects.filter(image=images[0]).count())
+        self.assertNotIn(Image.objects.get(pk=images[0].pk).thumbnail.name, dropped_names)
+
+    @override_settings(THUMBNAIL_WORKERS=2)
+    def test_render_many_in_process_pool(self):
+        images = [make_image(size=(300, 200)), make_image(size=(200, 300))]
+        jobs = [(image.uploaded_image.path, [('thumbnail', (128, 128))], ['png']) for image in images]
+        jobs.append(('missing.png', [('thumbnail', (128, 128))], ['png']))
+
+        first, second, missing = engine.render_many(jobs)
+
+        self.assertEqual([(rendering.width, rendering.height) for rendering in first.renderings + second.renderings],
+                         [(128, 85), (85, 128)])
+        self.assertIsInstance(missing, FileNotFoundError)
+
+    @override_settings(THUMBNAIL_WORKERS=2)
+    def test_render_many_after_worker_died(self):
+        class BreakingExecutor(ThreadPoolExecutor):
+            broken = False
+            def submit(self, fn, *args):
+                if BreakingExecutor.broken: return super().submit(fn, *args)
+                BreakingExecutor.broken = True
+                future = Future()
+                future.set_exception(BrokenProcessPool('a worker died'))
+                return future
+
+        image = make_image(size=(300, 200))
+        jobs = [(image.uploaded_image.path, [('thumbnail', (128, 128))], ['png'])] * 2
+        with mock.patch.object(engine, 'executor', None), \
+             mock.patch.object(engine, 'ProcessPoolExecutor', side_effect=lambda **kwargs: BreakingExecutor()):
+            first, second = engine.render_many(jobs)
+            self.assertEqual(engine.ProcessPoolExecutor.call_count, 2)
+
+        self.assertEqual([rendering.width for rendering in first.renderings + second.renderings], [128, 128])
+
+    def test_render_jpeg_in_draft_mode(self):
+        path = os.path.join(media_root.name, 'draft.jpg')
+        PilImage.new('RGB', size=(4000, 2000), color=(95, 0, 0)).save(path)
+        sizes = [('thumbnail', (128, 128)), ('large', (1024, 1024))]
+
+        with mock.patch.object(JpegImageFile, 'draft', autospec=True, side_effect=JpegImageFile.draft) as draft:
+            renderings = engine.render(path, sizes, ['png'], reducing_gap=2.0).renderings
+
+        self.assertEqual(draft.call_args_list[0], mock.call(mock.ANY, None, (2048, 1024)))
+        self.assertEqual([(rendering.name, rendering.width, rendering.height) for rendering in renderings],
+                         [('large', 1024, 512), ('thumbnail', 128, 64)])
+
+    def test_render_thin_jpeg_in_draft_mode(self):
+        path = os.path.join(media_root.name, 'thin.jpg')
+        PilImage.new('RGB', size=(20000, 3), color=(95, 0, 0)).save(path)
+
+        renderings = engine.render(path, [('thumbnail', (128, 128))], ['png'], reducing_gap=2.0).renderings
+
+        self.assertEqual([(rendering.width, rendering.height) for rendering in renderings], [(128, 1)])
+
+    def test_benchmark_thumbnails_command(self):
+        stdout = io.StringIO()
+        call_command('benchmark_thumbnails', count=1, size='600x400', formats=['png'], stdout=stdout)
+
+        self.assertIn('full decode:', stdout.getvalue())
+        self.assertIn('draft, reducing gap', stdout.getvalue())
+
+    def test_thumbnails_command(self):
+        images = [make_image(size=(100 + i, 100)) for i in range(3)]
+
+        stdout = io.StringIO()
+        call_command('thumbnails', batch_size=2, stdout=stdout)
+
+        self.assertIn('Made 3 of 3 thumbnails', stdout.getvalue())
+        self.assertFalse(Image.objects.filter(pk__in=[image.pk for image in images], thumbnail='').exists())
+
+    def test_thumbnails_command_resumes_from_checkpoint(self):
+        images = [make_image(size=(110 + i, 100)) for i in range(3)]
+        checkpoint = os.path.join(media_root.name, 'thumbnails.checkpoint')
+        with open(checkpoint, 'w') as file:
+            file.write(str(images[0].pk))
+
+        stdout = io.StringIO()
+        call_command('thumbnails', checkpoint=checkpoint, stdout=stdout)
+
+        self.assertIn(f'resuming after image {images[0].pk}', stdout.getvalue())
+        self.assertIn('Made 2 of 2 thumbnails', stdout.getvalue())
+        self.assertEqual(list(Image.objects.without_thumbnail()), [images[0]])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_thumbnails_command_remakes_outdated(self):
+        images = [make_image(size=(300, 200)), make_image(size=(200, 300))]
+        with mock.patch.object(Image, 'rendition_formats', []):
+            images[0].make_thumbnail_now()
+        images[1].make_thumbnail_now()
+        old_thumbnail = images[0].thumbnail.name
+
+        self.assertEqual(list(Image.objects.outdated()), [images[0]])
+        with mock.patch.object(Image, 'thumbnail_size', (64, 64)):
+            self.assertEqual(list(Image.objects.outdated()), images)
+
+        with mock.patch('pictures.models.delete_files') as delete_files:
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('thumbnails', outdated=True, stdout=io.StringIO())
+
+        images[0].refresh_from_db()
+        self.assertTrue(images[0].renditions.filter(name='thumbnail', format='webp').exists())
+        self.assertIn(old_thumbnail, delete_files.apply_async.call_args.kwargs['args'][0])
+        self.assertNotEqual(images[0].thumbnail.name, old_thumbnail)
+        self.assertFalse(Image.objects.outdated().exists())
+
+    def test_image_dhash(self):
+        image = make_image(size=(20, 20))
+        self.assertIsNone(image.dhash)
+        self.assertEqual(list(Image.objects.outdated()), [])
+
+        image.make_thumbnail_now()
+        image.refresh_from_db()
+        self.assertEqual(image.dhash, engine.get_file_dhash(image.thumbnail.path))
+
+        Image.objects.filter(pk=image.pk).update(dhash_0=None)
+        self.assertEqual(list(Image.objects.outdated()), [image])
+
+    def test_similar_images(self):
+        images = [make_image(size=(20 + i, 20)) for i in range(4)]
+        for image, dhash in zip(images, [0x0123456789abcdef, 0x0123456789abcdee, 0x0123456789abcde8, 0xffff]):
+            image.dhash = dhash
+            image.save(update_fields=Image.dhash_fields)
+
+        self.assertEqual(list(Image.objects.similar_to(0x0123456789abcdef)), images[:3])
+        self.assertEqual(list(Image.objects.similar_to(0x0123456789abcdef, max_distance=1)), images[:2])
+
+    @override_settings(MERGE_SIMILAR_UPLOADS=True)
+    def test_merge_similar_uploads(self):
+        original_bytes, resized_bytes = make_pattern_image_bytes(), make_pattern_image_bytes(size=(200, 200))
+        image = Image.objects.create(uploaded_image=SimpleUploadedFile('a.png', original_bytes.read()))
+        similar_image = Image.objects.create(uploaded_image=SimpleUploadedFile('b.png', resized_bytes.read()))
+        other_bytes = make_pattern_image_bytes(angle=90)
+        other_image = Image.objects.create(uploaded_image=SimpleUploadedFile('c.png', other_bytes.read()))
+
+        self.assertIsNotNone(image.dhash)
+        self.assertEqual(similar_image, image)
+        self.assertNotEqual(other_image, image)
+
+    @override_settings(MERGE_SIMILAR_UPLOADS=True)
+    def test_merge_similar_uploads_only_when_they_look_same(self):
+        image = Image.objects.create(uploaded_image=SimpleUploadedFile('a.png', make_pattern_image_bytes().read()))
+        stretched_bytes = make_pattern_image_bytes(size=(256, 128))
+        stretched_image = Image.objects.create(uploaded_image=SimpleUploadedFile('b.png', stretched_bytes.read()))
+        tinted_bytes = io.BytesIO()
+        pattern = PilImage.open(make_pattern_image_bytes()).convert('L')
+        ImageOps.colorize(pattern, black=(0, 0, 80), white=(255, 255, 255)).save(tinted_bytes, 'png')
+        tinted_image = Image.objects.create(uploaded_image=SimpleUploadedFile('c.png', tinted_bytes.getvalue()))
+        red_image = Image.objects.create(uploaded_image=SimpleUploadedFile('d.png', make_image_bytes().read()))
+        blue_bytes = io.BytesIO()
+        PilImage.new('RGB', size=(16, 16), color=(0, 0, 95)).save(blue_bytes, 'png')
+        blue_image = Image.objects.create(uploaded_image=SimpleUploadedFile('e.png', blue_bytes.getvalue()))
+
+        self.assertEqual(engine.get_distance(image.dhash, stretched_image.dhash), 0)
+        self.assertEqual(engine.get_distance(image.dhash, tinted_image.dhash), 0)
+        self.assertEqual(len({image, stretched_image, tinted_image, red_image, blue_image}), 5)
+
+    def test_delete_orphans_now(self):
+        orphan, referenced, waiting = make_image(size=(20, 20)), make_image(size=(21, 21)), make_image(size=(22, 22))
+        orphan.make_thumbnail_now()
+        referenced.make_thumbnail_now()
+        Picture.objects.create(name='picture', image=referenced, owner=User.objects.create(username='user'))
+        rendition_names = list(orphan.renditions.values_list('file', flat=True))
+
+        with mock.patch('pictures.models.delete_files') as delete_files:
+            with self.captureOnCommitCallbacks(execute=True):
+                deleted_count = Image.delete_orphans_now([orphan.pk, referenced.pk, waiting.pk])
+
+        self.assertEqual(deleted_count, 1)
+        self.assertEqual(list(Image.objects.all()), [referenced, waiting])
+        names = delete_files.apply_async.call_args.kwargs['args'][0]
+        self.assertIn(orphan.uploaded_image.name, names)
+        self.assertIn(orphan.thumbnail.name, names)
+        self.assertTrue(set(rendition_names) <= set(names))
+
+    def test_collect_orphans(self):
+        orphans = [make_image(size=(30 + i, 30)) for i in range(3)]
+        referenced = make_image(size=(40, 40))
+        for image in [*orphans, referenced]:
+            image.make_thumbnail_now()
+        Picture.objects.create(name='picture', image=referenced, owner=User.objects.create(username='user'))
+        make_image(size=(41, 41))
+
+        with mock.patch('pictures.models.delete_files'), self.assertLogs('pictures.models') as logs:
+            deleted_count = Image.collect_orphans(batch_size=2)
+
+        self.assertEqual(deleted_count, 3)
+        self.assertEqual(Image.objects.count(), 2)
+        self.assertIn('Collected 3 orphan images', logs.output[0])
+
+    def test_collect_orphans_with_drifted_ref_counts(self):
+        undercounted, overcounted = make_image(size=(42, 42)), make_image(size=(43, 43))
+        for image in [undercounted, overcounted]:
+            image.make_thumbnail_now()
+        Picture.objects.bulk_create([Picture(name='picture', image=undercounted,
+                                             owner=User.objects.create(username='user'))])
+        Image.objects.filter(pk=overcounted.pk).update(ref_count=2)
+
+        with mock.patch('pictures.models.delete_files'), self.assertLogs('pictures.models') as logs:
+            deleted_count = Image.collect_orphans()
+
+        self.assertEqual(deleted_count, 1)
+        self.assertEqual(list(Image.objects.values_list('pk', 'ref_count')), [(undercounted.pk, 1)])
+        self.assertIn('fixed 2 reference counts', logs.output[0])
+
+        Image.change_ref_counts([undercounted.pk, undercounted.pk], delta=-1)
+        undercounted.refresh_from_db()
+        self.assertEqual(undercounted.ref_count, 0)
+
+    def test_delete_files_task(self):
+        image = make_image(size=(23, 23))
+        path = image.uploaded_image.path
+        image.make_thumbnail_now()
+        image.delete()
+
+        tasks.delete_files([image.uploaded_image.name, 'missing.png'])
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_delete_files_task_keeps_referenced_files(self):
+        image = make_image(size=(24, 23))
+        path = image.uploaded_image.path
+
+        tasks.delete_files([image.uploaded_image.name])
+
+        self.assertTrue(os.path.exists(path))
+
+    def test_shard_media_command(self):
+        image = make_image(size=(50, 50))
+        image.make_thumbnail_now()
+        sha256_hash = hashlib.sha256(b'flat').hexdigest()
+        flat_name = f'images/{sha256_hash}.png'
+        os.replace(image.uploaded_image.path, os.path.join(media_root.name, flat_name))
+        Image.objects.filter(pk=image.pk).update(uploaded_image=flat_name)
+        rendition = image.renditions.first()
+        flat_rendition_name = rendition.file.name
+        self.assertEqual(flat_rendition_name.count('/'), 3)
+        Rendition.objects.filter(pk=rendition.pk).update(file=f'renditions/{os.path.basename(flat_rendition_name)}')
+        os.replace(rendition.file.path, os.path.join(media_root.name, 'renditions', os.path.basename(flat_rendition_name)))
+
+        stdout = io.StringIO()
+        with mock.patch('pictures.management.commands.shard_media.delete_files') as delete_files:
+            call_command('shard_media', '--grace-period=60', stdout=stdout)
+
+        image.refresh_from_db()
+        rendition.refresh_from_db()
+        self.assertEqual(image.uploaded_image.name, f'images/{sha256_hash[:2]}/{sha256_hash[2:4]}/{sha256_hash}.png')
+        self.assertTrue(os.path.exists(image.uploaded_image.path))
+        self.assertTrue(os.path.exists(os.path.join(media_root.name, flat_name)))
+        self.assertEqual(delete_files.apply_async.call_args_list, [
+            mock.call(args=([flat_name],), ignore_result=True, countdown=60),
+            mock.call(args=([f'renditions/{os.path.basename(flat_rendition_name)}'],), ignore_result=True, countdown=60),
+        ])
+        self.assertEqual(rendition.file.name, flat_rendition_name)
+        self.assertTrue(os.path.exists(rendition.file.path))
+        self.assertIn('Moved 1 image files', stdout.getvalue())
+        self.assertIn('Moved 1 rendition files', stdout.getvalue())
+
+    def test_make_webp_thumbnail(self):
+        image = make_image(size=(600, 300))
+        image.make_thumbnail_now()
+
+        self.assertEqual(image.get_thumbnail(), image.thumbnail)
+        self.assertEqual(image.get_thumbnail(['png']), image.thumbnail)
+        webp_thumbnail = image.get_thumbnail(['webp'])
+        self.assertTrue(webp_thumbnail.name.endswith('.webp'))
+        with PilImage.open(webp_thumbnail.path) as thumbnail:
+            self.assertEqual(thumbnail.format, 'WEBP')
+            self.assertEqual(thumbnail.size, (128, 64))
+
+
+@override_media_root
+class UploadHandlerTestCase(TestCase):
+    def test_hash_uploaded_chunks(self):
+        content = make_image_bytes(size=(300, 300)).read()
+        handler = TemporaryFileUploadHandler()
+        handler.new_file('image', 'test.png', 'image/png', len(content))
+        for start in range(0, len(content), 1000):
+            handler.receive_data_chunk(content[start:start + 1000], start)
+        uploaded_image = handler.file_complete(len(content))
+
+        sha256_hash = hashlib.sha256(content).hexdigest()
+        self.assertEqual(uploaded_image.sha256, sha256_hash)
+
+        image = Image.objects.create(uploaded_image=uploaded_image)
+        self.assertEqual(image.uploaded_image.name, f'images/{sha256_hash[:2]}/{sha256_hash[2:4]}/{sha256_hash}.png')
+        self.assertFalse(os.path.exists(uploaded_image.temporary_file_path()))
+        self.assertEqual(image.uploaded_image.read(), content)
+        uploaded_image.close()
+
+
+# stands in for storages like S3 whose files have no local paths
+class RemoteStorage(InMemoryStorage):
+    def _relative_path(self, name):
+        return os.path.relpath(super().path(name), self.location)
+
+    def path(self, name):
+        raise NotImplementedError("This backend doesn't support absolute paths.")
+
+override_remote_storage = override_settings(STORAGES={
+    'default': {'BACKEND': 'pictures.tests.RemoteStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+})
+
+@override_remote_storage
+class FileCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.override_cache_dir = override_settings(MEDIA_CACHE_DIR=self.cache_dir.name)
+        self.override_cache_dir.enable()
+
+    def tearDown(self):
+        self.override_cache_dir.disable()
+        self.cache_dir.cleanup()
+
+    def test_get_path_downloads_once(self):
+        name = default_storage.save('images/a.png', ContentFile(b'content'))
+
+        with mock.patch.object(default_storage, 'open', wraps=default_storage.open) as storage_open:
+            path = filecache.get_path(default_storage, name)
+            self.assertEqual(filecache.get_path(default_storage, name), path)
+
+        self.assertEqual(storage_open.call_count, 1)
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'content')
+
+    @override_settings(MEDIA_CACHE_SIZE=10)
+    def test_evict_least_recently_used(self):
+        names = [default_storage.save(f'images/{name}.png', ContentFile(b'12345')) for name in 'abc']
+        paths = [filecache.get_path(default_storage, name) for name in names[:2]]
+        os.utime(paths[0], (0, 0))
+        os.utime(paths[1], (1, 1))
+        filecache.get_path(default_storage, names[0])
+
+        filecache.get_path(default_storage, names[2])
+
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False])
+
+    def test_get_paths_keeps_files_in_use(self):
+        names = [default_storage.save(f'images/{name}.png', ContentFile(b'12345')) for name in 'ab']
+
+        with override_settings(MEDIA_CACHE_SIZE=5):
+            with filecache.get_paths(default_storage, names) as paths:
+                self.assertEqual([os.path.exists(path) for path in paths], [True, True])
+                os.utime(paths[0], (0, 0))
+
+        self.assertEqual([os.path.exists(path) for path in paths], [False, True])
+
+    def test_failed_download_leaves_no_file(self):
+        name = default_storage.save('images/a.png', ContentFile(b'content'))
+
+        with mock.patch('shutil.copyfileobj', side_effect=OSError('connection reset')):
+            with self.assertRaises(OSError):
+                filecache.get_path(default_storage, name)
+
+        self.assertEqual(os.listdir(self.cache_dir.name), [])
+
+    def test_make_thumbnails_larger_than_cache(self):
+        images = [Image.objects.create(uploaded_image=SimpleUploadedFile(f'{size}.png', make_image_bytes(size=(size, 20)).read()))
+                  for size in [300, 301, 302]]
+
+        with override_settings(MEDIA_CACHE_SIZE=1):
+            self.assertEqual(Image.make_thumbnails_now([image.pk for image in images]), images)
+
+    def test_make_thumbnails_without_local_paths(self):
+        uploaded_image = SimpleUploadedFile('a.png', make_image_bytes(size=(300, 200)).read())
+        image = Image.objects.create(uploaded_image=uploaded_image)
+        with self.assertRaises(NotImplementedError):
+            image.uploaded_image.path
+
+        self.assertEqual(Image.make_thumbnails_now([image.pk]), [image])
+
+        image.refresh_from_db()
+        with PilImage.open(image.thumbnail) as thumbnail:
+            self.assertEqual(thumbnail.size, (128, 85))
+
+
+# keeps objects of the buckets in a dict instead of talking to S3
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, bucket, key):
+        if (bucket, key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return self.objects[bucket, key]
+
+    def upload_fileobj(self, file, bucket, key, ExtraArgs=None, Config=None):
+        self.objects[bucket, key] = {'Body': file.read(), 'LastModified': datetime.now(timezone.utc), **ExtraArgs}
+
+    def download_fileobj(self, bucket, key, file, Config=None):
+        file.write(self.get_object(bucket, key)['Body'])
+
+    def head_object(self, Bucket, Key):
+        s3_object = self.get_object(Bucket, Key)
+        return {'ContentLength': len(s3_object['Body']), **s3_object}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+override_s3_storage = override_settings(STORAGES={
+    'default': {'BACKEND': 'pictures.s3storage.ShardedS3Storage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}, S3_BUCKET='media')
+
+@mock.patch.object(S3Storage, 'client', new_callable=FakeS3Client)
+class S3StorageTestCase(TestCase):
+    def test_save_and_open(self, client):
+        storage = ShardedS3Storage(bucket='media')
+
+        name = storage.save('images/a.png', ContentFile(b'content'))
+
+        self.assertEqual(name, 'images/a.png')
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(storage.size(name), 7)
+        with storage.open(name) as file:
+            self.assertEqual(file.read(), b'content')
+        self.assertEqual(client.objects['media', name]['ContentType'], 'image/png')
+        self.assertNotIn('CacheControl', client.objects['media', name])
+
+    def test_save_renames_taken_names(self, client):
+        storage = ShardedS3Storage(bucket='media')
+        name = storage.save('images/a.png', ContentFile(b'content'))
+
+        self.assertNotEqual(storage.save('images/a.png', ContentFile(b'other')), name)
+
+        with storage.open(name) as file:
+            self.assertEqual(file.read(), b'content')
+
+    def test_save_content_addressed_names_in_place(self, client):
+        storage = ShardedS3Storage(bucket='media')
+        sha256_hash = hashlib.sha256(b'content').hexdigest()
+
+        name = storage.save(f'images/{sha256_hash}.png', ContentFile(b'content'))
+
+        self.assertEqual(name, f'images/{sha256_hash}.png')
+        self.assertEqual(storage.save(name, ContentFile(b'content')), name)
+        self.assertEqual(list(client.objects), [('media', name)])
+        self.assertEqual(client.objects['media', name]['CacheControl'], 'public, max-age=31536000, immutable')
+
+    def test_delete(self, client):
+        storage = ShardedS3Storage(bucket='media')
+        name = storage.save('images/a.png', ContentFile(b'content'))
+
+        storage.delete(name)
+
+        self.assertFalse(storage.exists(name))
+        with self.assertRaises(FileNotFoundError):
+            storage.size(name)
+        with self.assertRaises(ClientError):
+            storage.open(name)
+
+    def test_head_raises_other_errors(self, client):
+        storage = ShardedS3Storage(bucket='media')
+        client.head_object = mock.Mock(side_effect=ClientError({'Error': {'Code': '403'}}, 'HeadObject'))
+
+        with self.assertRaises(ClientError):
+            storage.exists('images/a.png')
+
+    def test_url(self, client):
+        storage = ShardedS3Storage(bucket='media', base_url='https://media.example.com/')
+
+        self.assertEqual(storage.url('images/a b.png'), 'https://media.example.com/images/a%20b.png')
+        with override_settings(MEDIA_URL_SIGNING_KEY='key', MEDIA_URL_LIFETIME=100), \
+             mock.patch('time.time', return_value=1000):
+            signature = base64.urlsafe_b64encode(hashlib.md5(b'1200/images/a b.png key').digest()).decode().rstrip('=')
+            self.assertEqual(storage.url('images/a b.png'),
+                             f'https://media.example.com/images/a%20b.png?md5={signature}&expires=1200')
+
+    @override_s3_storage
+    def test_create_same_image_concurrently(self, client):
+        content = make_image_bytes(size=(37, 31)).read()
+        image = Image.objects.create(uploaded_image=SimpleUploadedFile('a.png', content))
+
+        # the other upload is not seen by the lookup, only by the unique constraint
+        with mock.patch.object(type(Image.objects), 'filter', return_value=Image.objects.none()):
+            same_image = Image.objects.create(uploaded_image=SimpleUploadedFile('b.png', content))
+
+        self.assertEqual(same_image, image)
+        self.assertEqual(list(client.objects), [('media', image.uploaded_image.name)])
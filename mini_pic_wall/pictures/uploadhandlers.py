@@ -0,0 +1,28 @@
+import hashlib
+from django.core.files import uploadhandler
+
+
+class SHA256UploadHandlerMixin:
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        remaining_data = super().receive_data_chunk(raw_data, start)
+        if remaining_data is None:
+            self.sha256.update(raw_data)
+        return remaining_data
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class MemoryFileUploadHandler(SHA256UploadHandlerMixin, uploadhandler.MemoryFileUploadHandler):
+    pass
+
+
+class TemporaryFileUploadHandler(SHA256UploadHandlerMixin, uploadhandler.TemporaryFileUploadHandler):
+    pass
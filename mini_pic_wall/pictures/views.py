@@ -2,19 +2,22 @@ from django.db.models.query import EmptyQuerySet
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.serializers import Serializer as EmptySerializer
 from rest_framework.decorators import action
+from rest_framework.generics import get_object_or_404
+from mini_pic_wall.cache import CachedResponseMixin
 from users import permissions
 from collages.models import Collage
-from collages.serializers import HyperlinkedCollageSerializer
+from collages.serializers import HyperlinkedCollageSerializer, expands
 from . import serializers
-from .models import Picture
+from .models import Image, Picture
 
 
-class PictureViewSet(ModelViewSet):
+class PictureViewSet(CachedResponseMixin, ModelViewSet):
     def get_object(self):
         if self.action == 'retrieve':
             assert 'thumbnail' in self.get_serializer_class().Meta.fields
             assert 'owner' in self.get_serializer_class().Meta.fields
-            picture = Picture.objects.select_related('image', 'owner').get(pk=self.kwargs['pk'])
+            picture = (Picture.objects.select_related('image', 'owner')
+                       .prefetch_related('image__renditions').get(pk=self.kwargs['pk']))
             # self.check_object_permissions(self.request, picture)
             return picture
         else:
@@ -25,15 +28,20 @@ class PictureViewSet(ModelViewSet):
     def get_queryset(self):
         match self.action:
             case 'list':
-                return Picture.objects.all()
+                return Picture.objects.with_thumbnails()
             case 'collages':
-                return Collage.objects.filter(pictures=self.kwargs['pk'])
+                return Collage.objects.with_covers().filter(pictures=self.kwargs['pk'])
+            case 'similar':
+                picture = get_object_or_404(Picture.objects.select_related('image'), pk=self.kwargs['pk'])
+                if picture.image.dhash is None: return Picture.objects.none()
+                similar_images = Image.objects.similar_to(picture.image.dhash)
+                return Picture.objects.with_thumbnails().filter(image__in=similar_images).exclude(pk=picture.pk)
             case _:
                 return EmptyQuerySet()
 
     def get_serializer_class(self):
         match self.action:
-            case 'list':
+            case 'list' | 'similar':
                 return serializers.HyperlinkedPictureSerializer
             case 'retrieve':
                 return serializers.PictureSerializer
@@ -42,6 +50,18 @@ class PictureViewSet(ModelViewSet):
             case _:
                 return EmptySerializer
 
+    def get_cache_scopes(self):
+        match self.action:
+            case 'list' | 'similar':
+                return ['pictures']
+            case 'retrieve':
+                return [f'picture:{self.kwargs["pk"]}']
+            case 'collages':
+                scopes = [f'picture:{self.kwargs["pk"]}', 'collages']
+                return scopes + ['pictures'] if expands(self.request, 'preview') else scopes
+            case _:
+                return None
+
     def get_permissions(self):
         permission_classes = [permissions.ReadOnly]
         if self.action == 'destroy':
@@ -51,3 +71,7 @@ class PictureViewSet(ModelViewSet):
     @action(detail=True, methods=['get'])
     def collages(self, request, pk=None):
         return self.list(request)
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        return self.list(request)
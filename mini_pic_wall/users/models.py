@@ -7,11 +7,11 @@ from collages.models import Collage
 class UserManager(auth.models.UserManager):
     def get_pictures_by_username(self, username):
         user = User.objects.filter(username=username)
-        return Picture.objects.filter(owner=Subquery(user.values('pk')))
+        return Picture.objects.with_thumbnails().filter(owner=Subquery(user.values('pk')))
 
     def get_collages_by_username(self, username):
         user = User.objects.filter(username=username)
-        return Collage.objects.filter(owner=Subquery(user.values('pk')))
+        return Collage.objects.with_covers().filter(owner=Subquery(user.values('pk')))
 
 
 class User(auth.models.User):
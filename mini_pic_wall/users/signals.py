@@ -0,0 +1,15 @@
+from django.contrib import auth
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from mini_pic_wall.cache import bump_versions_on_commit
+from .models import User
+
+
+@receiver(post_save, sender=auth.models.User, dispatch_uid="invalidate_saved_user")
+@receiver(post_save, sender=User, dispatch_uid="invalidate_saved_proxy_user")
+def invalidate_saved_user(sender, instance, created, update_fields, **kwargs):
+    if created:
+        bump_versions_on_commit(['users'])
+    elif update_fields is None or set(update_fields) != {'last_login'}:
+        # usernames are part of links in almost every response
+        bump_versions_on_commit(['all'])
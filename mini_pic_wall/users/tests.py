@@ -1,14 +1,21 @@
+import hashlib
 from django.urls import resolve
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from rest_framework import test
 from rest_framework.reverse import reverse
 from collages.models import Collage
-from pictures.tests import make_image_bytes, make_picture
+from pictures.models import Image
+from pictures.serializers import PictureSerializer
+from pictures.tests import make_image_bytes, make_picture, override_media_root
+from unittest import mock
 
 
+@override_media_root
 class UserViewAPITestCase(test.APITestCase):
     def setUp(self):
         self.factory = test.APIRequestFactory()
+        cache.clear()
 
     def test_list_users(self):
         user1 = User.objects.create(username='user_name_1')
@@ -19,7 +26,7 @@ class UserViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('user-detail', request=request, args=[user1.username]))
         self.assertEqual(response.data['results'][0]['username'], user1.username)
@@ -257,7 +264,7 @@ class UserViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request, username=user.username)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
 
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('picture-detail', request=request, args=[picture1.pk]))
@@ -283,6 +290,90 @@ class UserViewAPITestCase(test.APITestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(user.pictures.count(), 1)
 
+    def test_upload_picture_by_sha256(self):
+        image_bytes = make_image_bytes(size=(24, 24))
+        sha256_hash = hashlib.sha256(image_bytes.read()).hexdigest()
+        image_bytes.seek(0)
+        user = User.objects.create(username='user')
+        url = reverse('user-pictures', args=[user.username])
+        self.client.force_authenticate(user=user)
+        self.client.post(url, {'name': 'first picture', 'image': image_bytes})
+
+        data = {'name': 'same picture', 'sha256': sha256_hash}
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(user.pictures.count(), 2)
+        first_picture, same_picture = user.pictures.all()
+        self.assertEqual(same_picture.name, data['name'])
+        self.assertEqual(same_picture.image, first_picture.image)
+
+    def test_upload_picture_by_unknown_sha256(self):
+        data = {'name': 'name for picture', 'sha256': '0' * 64}
+        user = User.objects.create(username='user')
+
+        url = reverse('user-pictures', args=[user.username])
+        self.client.force_authenticate(user=user)
+        response = self.client.post(url, data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('sha256', response.data)
+        self.assertEqual(user.pictures.count(), 0)
+
+    def test_upload_picture_by_sha256_of_collected_orphan(self):
+        user = User.objects.create(username='user')
+        url = reverse('user-pictures', args=[user.username])
+        self.client.force_authenticate(user=user)
+        self.client.post(url, {'name': 'first picture', 'image': make_image_bytes(size=(23, 23))})
+        picture = user.pictures.get()
+        picture.image.make_thumbnail_now()
+        sha256_hash = picture.image.sha256
+        validate = PictureSerializer.validate
+
+        # the orphan collector deletes the image between validation and saving
+        def validate_and_collect(serializer, data):
+            data = validate(serializer, data)
+            picture.delete()
+            Image.delete_orphans_now([data['same_image'].pk])
+            return data
+
+        with mock.patch.object(PictureSerializer, 'validate', validate_and_collect):
+            response = self.client.post(url, {'name': 'same picture', 'sha256': sha256_hash}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('sha256', response.data)
+        self.assertEqual(user.pictures.count(), 0)
+
+    def test_upload_pictures(self):
+        first_bytes, second_bytes, same_bytes = (make_image_bytes(size=(40, 40)),
+                                                 make_image_bytes(size=(41, 41)),
+                                                 make_image_bytes(size=(40, 40)))
+        first_bytes.name, second_bytes.name, same_bytes.name = 'first.png', 'second.png', 'same.png'
+        user = User.objects.create(username='user')
+
+        url = reverse('user-pictures-bulk', args=[user.username])
+        self.client.force_authenticate(user=user)
+        response = self.client.post(url, {'images': [first_bytes, second_bytes, same_bytes]})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['pictures']), 3)
+        self.assertEqual([picture.name for picture in user.pictures.all()], ['first', 'second', 'same'])
+        first_picture, second_picture, same_picture = user.pictures.all()
+        self.assertNotEqual(first_picture.image, second_picture.image)
+        self.assertEqual(first_picture.image, same_picture.image)
+        self.assertEqual([first_picture.image.ref_count, second_picture.image.ref_count], [2, 1])
+
+    def test_upload_pictures_using_wrong_user(self):
+        user = User.objects.create(username='user')
+        wrong_user = User.objects.create(username='wrong_user')
+
+        url = reverse('user-pictures-bulk', args=[user.username])
+        self.client.force_authenticate(user=wrong_user)
+        response = self.client.post(url, {'images': [make_image_bytes()]})
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(user.pictures.count(), 0)
+
     def test_upload_picture_with_no_auth(self):
         data = {
             'name': 'name for picture',
@@ -321,7 +412,7 @@ class UserViewAPITestCase(test.APITestCase):
         response = resolve(url).func(request, username=user.username)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['url'],
                          reverse('collage-detail', request=request, args=[collage1.pk]))
         self.assertEqual(response.data['results'][0]['name'], collage1.name)
@@ -4,13 +4,14 @@ from rest_framework.serializers import Serializer as EmptySerializer
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.reverse import reverse
+from mini_pic_wall.cache import CachedResponseMixin
 import pictures.serializers
 import collages.serializers
 from . import serializers, permissions
 from .models import User
 
 
-class UserViewSet(ModelViewSet):
+class UserViewSet(CachedResponseMixin, ModelViewSet):
     lookup_field = 'username'
 
     def get_object(self):
@@ -44,6 +45,8 @@ class UserViewSet(ModelViewSet):
                     'GET': pictures.serializers.HyperlinkedPictureSerializer,
                     'POST': pictures.serializers.PictureSerializer,
                 }.get(self.request.method, EmptySerializer)
+            case 'bulk_pictures':
+                return pictures.serializers.BulkPictureSerializer
             case 'collages':
                 return {
                     'GET': collages.serializers.HyperlinkedCollageSerializer,
@@ -52,11 +55,20 @@ class UserViewSet(ModelViewSet):
             case _:
                 return EmptySerializer
 
+    def get_cache_scopes(self):
+        match self.action:
+            case 'list':
+                return ['users']
+            case 'retrieve' | 'pictures' | 'collages':
+                return [f'user:{self.kwargs["username"]}']
+            case _:
+                return None
+
     def get_permissions(self):
         match self.action:
             case 'change' | 'deactivate':
                 permission_classes = [permissions.IsUserThemself]
-            case 'pictures' | 'collages':
+            case 'pictures' | 'bulk_pictures' | 'collages':
                 permission_classes = [permissions.IsUserThemselfOrReadOnly]
             case 'create':
                 permission_classes = []
@@ -91,6 +103,10 @@ class UserViewSet(ModelViewSet):
     def pictures(self, request, username=None):
         return self.list_or_create(request)
 
+    @action(detail=True, methods=['post'], url_path='pictures/bulk', url_name='pictures-bulk')
+    def bulk_pictures(self, request, username=None):
+        return self.create(request)
+
     @action(detail=True, methods=['get', 'post'])
     def collages(self, request, username=None):
         return self.list_or_create(request)